@@ -0,0 +1,170 @@
+# regression.py
+# Accuracy-guarded performance regression harness
+# Reruns the reference configurations recorded in config.py end to end and checks that
+# the clustering labels and ARI are unchanged, reporting the runtime alongside
+# Author: Boqian Shi
+#
+# Usage (from the repository root):
+#     python -m benchmarks.regression                 # real data, synthetic if ./data is missing
+#     python -m benchmarks.regression --synthetic     # synthetic cohort only
+#     python -m benchmarks.regression --record        # overwrite the stored reference labels
+#     python -m benchmarks.regression --model-arg max_iter_interp=200
+#
+# Exits with status 1 when any configuration drifts beyond the tolerance.
+
+import argparse
+import ast
+import json
+import os
+import sys
+import tempfile
+import time
+
+from sklearn.metrics import adjusted_rand_score
+
+import config
+import main
+import src.clustering
+from src.synthetic import generate_cohort
+
+REFERENCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference_labels.json')
+
+# Hyperparameters of main.k_centroids_test
+MODEL_ARGS = {
+    'top_relative_weight': 0.25,
+    'max_iter_alt': 300,
+    'max_iter_interp': 300,
+    'learning_rate': 0.05
+}
+
+# Reference results from config.py. The mixed separation ARI of 0.154 does not come out of
+# the k_centroids_test hyperparameters (they give 0.1283 for seed 86), so that configuration
+# is pinned to its recorded labels only
+REAL_REFERENCES = [
+    {'name': 'strict_binary', 'separation_mode': 'strict_binary', 'label_mode': 'binary',
+     'random_seed': 2957, 'ari': 0.4271},
+    {'name': 'mixed_separation', 'separation_mode': 'mixed_separation', 'label_mode': 'binary',
+     'random_seed': 86, 'ari': None},
+]
+
+# Synthetic cohort used when the real matrices are unavailable, its reference ARI is
+# taken from the recorded labels
+SYNTHETIC_COHORT = {'n_subjects': 60, 'n_nodes': 100, 'seed': 0}
+SYNTHETIC_REFERENCES = [
+    {'name': 'synthetic_strict_binary', 'separation_mode': 'strict_binary', 'label_mode': 'binary',
+     'random_seed': 0, 'ari': None},
+]
+
+
+def run_reference(reference, model_args):
+    """
+    Runs one reference configuration through main.load_content and k_centroids_clustering.
+
+    Args:
+        reference (dict): Configuration overrides and expected ARI.
+        model_args (dict): Arguments of k_centroids_clustering.
+
+    Returns:
+        tuple: Predicted labels, ARI and runtime of the clustering in seconds.
+    """
+    config.separation_mode = reference['separation_mode']
+    config.label_mode = reference['label_mode']
+    config.random_seed = reference['random_seed']
+    config.barcode_mode = "attached"
+    config.adj_mode = "ignore_negative"
+    config.geo_mode = "geo_included"
+
+    subject_manager = main.load_content()
+    main.generate_barcode(subject_manager)
+    labels_true = subject_manager.get_labels()
+
+    args = dict(model_args)
+    model = src.clustering.k_centroids_clustering(
+        subject_manager, main.get_cluster_number(), args.pop('top_relative_weight'),
+        args.pop('max_iter_alt'), args.pop('max_iter_interp'), args.pop('learning_rate'), **args)
+    start = time.perf_counter()
+    labels_pred = model.fit_predict()
+    runtime = time.perf_counter() - start
+    return [int(label) for label in labels_pred], adjusted_rand_score(labels_true, labels_pred), runtime
+
+
+def parse_model_args(pairs):
+    """Parses name=value pairs, values are Python literals or plain strings."""
+    model_args = dict(MODEL_ARGS)
+    for pair in pairs:
+        name, value = pair.split('=', 1)
+        try:
+            model_args[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            model_args[name] = value
+    return model_args
+
+
+def main_regression():
+    parser = argparse.ArgumentParser(description="Check that the reference clustering results are reproduced.")
+    parser.add_argument('--synthetic', action='store_true', help="run on a generated cohort instead of ./data")
+    parser.add_argument('--record', action='store_true', help="store the labels as the new references")
+    parser.add_argument('--tolerance', type=float, default=1e-3, help="allowed absolute ARI drift")
+    parser.add_argument('--model-arg', action='append', default=[], metavar='NAME=VALUE',
+                        help="override an argument of k_centroids_clustering")
+    parser.add_argument('--references', default=REFERENCE_FILE, help="JSON file of recorded labels")
+    args = parser.parse_args()
+
+    model_args = parse_model_args(args.model_arg)
+    synthetic = args.synthetic or not os.path.isdir(config.data_dir) or not os.listdir(config.data_dir)
+
+    stored = {}
+    if os.path.exists(args.references):
+        with open(args.references, 'r') as file:
+            stored = json.load(file)
+
+    saved_config = {name: value for name, value in vars(config).items() if not name.startswith('__')}
+    temp_dir = None
+    if synthetic:
+        temp_dir = tempfile.TemporaryDirectory()
+        config.data_dir = os.path.join(temp_dir.name, 'data')
+        config.subject_csv_file = os.path.join(temp_dir.name, 'matrix_subjects.csv')
+        generate_cohort(config.data_dir, config.subject_csv_file, SYNTHETIC_COHORT['n_subjects'],
+                        SYNTHETIC_COHORT['n_nodes'], seed=SYNTHETIC_COHORT['seed'], n_jobs=1)
+        references = SYNTHETIC_REFERENCES
+    else:
+        references = REAL_REFERENCES
+
+    failed = False
+    try:
+        for reference in references:
+            labels_pred, ari_score, runtime = run_reference(reference, model_args)
+            expected = stored.get(reference['name'])
+            status = "recorded"
+            if not args.record:
+                problems = []
+                expected_ari = reference['ari'] if reference['ari'] is not None else (expected or {}).get('ari')
+                if expected_ari is not None and abs(ari_score - expected_ari) > args.tolerance:
+                    problems.append(f"ARI {ari_score:.4f} != {expected_ari:.4f}")
+                if expected is not None:
+                    # Compare partitions, so a swap of the cluster indices is not a change
+                    agreement = adjusted_rand_score(expected['labels'], labels_pred)
+                    if agreement < 1 - args.tolerance:
+                        problems.append(f"labels changed (ARI vs reference {agreement:.4f})")
+                if expected_ari is None and expected is None:
+                    problems.append("no reference recorded, run with --record")
+                status = "FAILED: " + ", ".join(problems) if problems else "ok"
+                failed = failed or bool(problems)
+            else:
+                stored[reference['name']] = {'ari': ari_score, 'labels': labels_pred}
+            print(f"{reference['name']:<26} seed {reference['random_seed']:<5} ARI {ari_score:.4f}  "
+                  f"{runtime:8.2f} s  {status}")
+    finally:
+        for name, value in saved_config.items():
+            setattr(config, name, value)
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    if args.record:
+        with open(args.references, 'w') as file:
+            json.dump(stored, file)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_regression())
@@ -0,0 +1,281 @@
+# run_benchmarks.py
+# Benchmark suite for the barcode, clustering and SVM hot paths
+# Runs on synthetic connectomes, so no ADNI data is needed
+# Author: Boqian Shi
+#
+# Usage (from the repository root):
+#     python -m benchmarks.run_benchmarks              # full grid
+#     python -m benchmarks.run_benchmarks --quick      # smallest cases only
+#     python -m benchmarks.run_benchmarks -k barcode   # cases whose name contains "barcode"
+#
+# Every run is appended to benchmarks/history.json together with the current commit,
+# and compared against the previous entry of the same case.
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+import config
+import src.barcode
+import src.clustering
+from src.subject import Subject
+from src.synthetic import planted_templates, synthetic_connectome, synthetic_subject_id
+from src.svm import run_svm_classification
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.json')
+
+# Parameter grids, the quick grid keeps the first value of every axis
+NODE_COUNTS = [60, 120, 360]
+COHORT_SIZES = [20, 60]
+ADJ_MODES = ["ignore_negative", "original"]
+GEO_MODES = ["geo_included", "topo"]
+
+
+class BenchmarkCohort:
+    """Minimal stand-in for SubjectLoader holding synthetic subjects."""
+
+    def __init__(self, subjects):
+        self.subjects = subjects
+
+    def get_labels(self):
+        return [subject.group for subject in self.subjects]
+
+
+def random_connectome(n_nodes, rng):
+    """Synthetic connectome of the first group, see src.synthetic."""
+    modules, strengths = planted_templates(n_nodes, 1)
+    return synthetic_connectome(modules, strengths[0], rng)
+
+
+def synthetic_cohort(n_subjects, n_nodes, seed=0, adj_mode="ignore_negative"):
+    """
+    Builds a two-group cohort of synthetic subjects with data and barcodes, in memory.
+
+    Args:
+        n_subjects (int): Number of subjects.
+        n_nodes (int): Number of nodes of each network.
+        seed (int): Seed of the random generator.
+        adj_mode (str): Adjacency matrix mode used for the barcodes.
+
+    Returns:
+        BenchmarkCohort: Cohort with subjects ready for clustering and classification.
+    """
+    modules, strengths = planted_templates(n_nodes, 2, seed=seed)
+    subjects = []
+    for i in range(n_subjects):
+        subject = Subject(synthetic_subject_id(i), group=i % 2)
+        subject.data = synthetic_connectome(modules, strengths[i % 2], np.random.default_rng([seed, i]))
+        subject.set_barcode(src.barcode.get_barcode(subject.data.copy(), adj_mode=adj_mode))
+        subjects.append(subject)
+    return BenchmarkCohort(subjects)
+
+
+# Each case returns (setup, run, n_items): setup builds the inputs outside of the timed
+# region, run(inputs) is the timed call and n_items is used for the throughput
+def case_bd_decomposition(n_nodes):
+    def setup():
+        return src.barcode.set_mode(random_connectome(n_nodes, np.random.default_rng(0)), "ignore_negative")
+    def run(adj):
+        src.barcode.bd_decomposition(adj.copy())
+    return setup, run, 1
+
+
+def case_get_barcode(n_nodes, adj_mode, geo_mode):
+    def setup():
+        config.geo_mode = geo_mode
+        return random_connectome(n_nodes, np.random.default_rng(0))
+    def run(adj):
+        src.barcode.get_barcode(adj.copy(), adj_mode=adj_mode)
+    return setup, run, 1
+
+
+def _clustering_model(cohort, max_iter_alt=3, max_iter_interp=20):
+    model = src.clustering.k_centroids_clustering(cohort, 2, 0.25, max_iter_alt, max_iter_interp, 0.05)
+    n_edges = cohort.subjects[0].barcode.shape[0] // 2
+    model.weight_array = np.append(np.repeat(1 - model.top_relative_weight, n_edges),
+                                   np.repeat(model.top_relative_weight, n_edges))
+    return model
+
+
+def case_top_interpolation(n_nodes, n_steps=20):
+    def setup():
+        config.geo_mode = "geo_included"
+        cohort = synthetic_cohort(4, n_nodes)
+        model = _clustering_model(cohort, max_iter_interp=n_steps)
+        X = model.barcode_to_array()
+        n_edges = X.shape[1] // 2
+        mean = X.mean(axis=0)
+        return model, X[0, :n_edges], mean[:n_edges], mean[n_edges:n_edges + n_nodes - 1], mean[n_edges + n_nodes - 1:]
+    def run(inputs):
+        model, init, sample_mean, births, deaths = inputs
+        model._top_interpolation(init.copy(), sample_mean, births, deaths)
+    return setup, run, n_steps
+
+
+def case_get_nearest_centroid(n_subjects, n_nodes):
+    def setup():
+        config.geo_mode = "geo_included"
+        cohort = synthetic_cohort(n_subjects, n_nodes)
+        model = _clustering_model(cohort)
+        X = model.barcode_to_array()
+        return model, X, X[:2].copy()
+    def run(inputs):
+        model, X, centroids = inputs
+        model._get_nearest_centroid(X[:, None, :], centroids[None, :, :])
+    return setup, run, n_subjects
+
+
+def case_fit_predict(n_subjects, n_nodes):
+    def setup():
+        config.geo_mode = "geo_included"
+        config.random_seed = 0
+        return _clustering_model(synthetic_cohort(n_subjects, n_nodes))
+    def run(model):
+        model.fit_predict()
+    return setup, run, n_subjects
+
+
+def case_run_svm_classification(n_subjects, n_nodes):
+    def setup():
+        config.geo_mode = "geo_included"
+        return synthetic_cohort(n_subjects, n_nodes).subjects
+    def run(subjects):
+        run_svm_classification(subjects, cv_folds=5)
+    return setup, run, n_subjects
+
+
+def build_cases(quick=False):
+    """
+    Lists every (name, params, case) combination of the benchmark grid.
+
+    Args:
+        quick (bool): Only keep the smallest value of every parameter axis.
+
+    Returns:
+        list: List of (name, params, case) tuples.
+    """
+    nodes = NODE_COUNTS[:1] if quick else NODE_COUNTS
+    cohorts = COHORT_SIZES[:1] if quick else COHORT_SIZES
+    adj_modes = ADJ_MODES[:1] if quick else ADJ_MODES
+    geo_modes = GEO_MODES[:1] if quick else GEO_MODES
+
+    cases = []
+    for n_nodes in nodes:
+        cases.append(("bd_decomposition", {'n_nodes': n_nodes}, case_bd_decomposition(n_nodes)))
+        for adj_mode, geo_mode in itertools.product(adj_modes, geo_modes):
+            params = {'n_nodes': n_nodes, 'adj_mode': adj_mode, 'geo_mode': geo_mode}
+            cases.append(("get_barcode", params, case_get_barcode(n_nodes, adj_mode, geo_mode)))
+        cases.append(("top_interpolation", {'n_nodes': n_nodes}, case_top_interpolation(n_nodes)))
+        for n_subjects in cohorts:
+            params = {'n_nodes': n_nodes, 'n_subjects': n_subjects}
+            cases.append(("get_nearest_centroid", params, case_get_nearest_centroid(n_subjects, n_nodes)))
+            cases.append(("fit_predict", params, case_fit_predict(n_subjects, n_nodes)))
+            cases.append(("run_svm_classification", params, case_run_svm_classification(n_subjects, n_nodes)))
+    return cases
+
+
+def measure(setup, run, n_items, repeat):
+    """
+    Times a case and records its peak traced memory.
+
+    The timed repetitions run without tracemalloc, the peak memory comes from one extra
+    traced call, so the tracing overhead never leaks into the timings.
+
+    Returns:
+        dict: Timing, throughput and peak memory of the case.
+    """
+    inputs = setup()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(inputs)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run(inputs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'mean_s': float(np.mean(times)),
+        'min_s': float(np.min(times)),
+        'throughput_per_s': n_items / float(np.min(times)),
+        'peak_mb': peak / 2**20
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_file):
+    if os.path.exists(history_file):
+        with open(history_file, 'r') as file:
+            return json.load(file)
+    return []
+
+
+def previous_result(history, name, params):
+    """Latest recorded result of the same case and its commit, or (None, None)."""
+    for entry in reversed(history):
+        for result in entry['results']:
+            if result['name'] == name and result['params'] == params:
+                return result, entry['commit']
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the barcode, clustering and SVM hot paths.")
+    parser.add_argument('--quick', action='store_true', help="only run the smallest cases")
+    parser.add_argument('-k', dest='keyword', default=None, help="only run cases whose name contains KEYWORD")
+    parser.add_argument('--repeat', type=int, default=3, help="timed repetitions per case")
+    parser.add_argument('--history', default=HISTORY_FILE, help="JSON history file")
+    parser.add_argument('--no-save', action='store_true', help="do not append the run to the history")
+    args = parser.parse_args()
+
+    saved_config = (config.geo_mode, config.random_seed)
+    history = load_history(args.history)
+    results = []
+    try:
+        for name, params, (setup, run, n_items) in build_cases(args.quick):
+            if args.keyword and args.keyword not in name:
+                continue
+            result = {'name': name, 'params': params}
+            result.update(measure(setup, run, n_items, args.repeat))
+            results.append(result)
+
+            line = f"{name:<24} {json.dumps(params):<72} {result['min_s']:9.4f} s  {result['peak_mb']:9.1f} MB"
+            previous, commit = previous_result(history, name, params)
+            if previous is not None:
+                line += f"  ({result['min_s'] / previous['min_s']:.2f}x time vs {commit})"
+            print(line)
+    finally:
+        config.geo_mode, config.random_seed = saved_config
+
+    if not args.no_save:
+        history.append({
+            'commit': current_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'machine': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'results': results
+        })
+        with open(args.history, 'w') as file:
+            json.dump(history, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -54,6 +54,34 @@ subject_csv_file = './matrix_subjects.csv'
 # debug flag
 debug = 0
 
+# Instrumentation flags
+# instrument = 1: record per-stage timers, counters and loss traces (src/instrument.py),
+#                 written to <entry point>_trace.json (Chrome trace) and
+#                 <entry point>_instrument.json after every entry point run by run_entry_point
+# profile = 1:    run each entry point under cProfile, stats written to <entry point>_profile.prof
+instrument = 0
+profile = 0
+
+# Memory accounting
+# memory_budget: maximum resident memory of the run in bytes (e.g. 8 * 2**30), None for no
+#                limit. Chunked code paths size their chunks to stay below it, and a stage
+#                that cannot fit stops the run early with a per-stage memory report
+# memory_tracking = 1: record the tracemalloc peak of every stage (slower), printed after the run
+memory_budget = None
+memory_tracking = 0
+
+# Directory caching the all-pairs topological distance blocks (src/distance.py),
+# keyed by the subjects and barcode settings; None to disable the cache
+distance_cache_dir = './distance_cache'
+
+# Figure output (src/figures.py)
+# headless = 1: no windows (Agg backend); figures are rendered by figure_workers background
+#               processes into results_dir instead of blocking on plt.show()
+# results_dir:  directory of the exported figures, in both modes
+headless = 0
+results_dir = './results'
+figure_workers = 2
+
 # Random seed
 # Best for strict binary separation = 2957; ari = 0.4271
 # Best for mixed_separation = 86, ari = 0.154
@@ -2,12 +2,23 @@
 # The main function that handles all the scripts and functions
 # Author: Boqian Shi
 
+import copy
 import logging
+import os
 import math
 import config
 import src.clustering
+import src.figures as figures
+from src.cache import CentroidCache
+from src.backends import BACKENDS, cluster_with_backend
+from src.coreset import build_coreset
+from src.distance import compute_topological_distances
+from src.feature_store import FeatureStore
+from src.minibatch import minibatch_k_centroids_clustering
+import src.instrument as instrument
+import src.memory as memory
 from src.subject import Subject, SubjectLoader
-from src.barcode import get_barcode, plot_cycle_barcode, plot_component_barcode
+from src.barcode import get_barcode, plot_cycle_barcode, plot_component_barcode, split_barcode, export_cohort_barcodes
 import numpy as np
 from sklearn.metrics.cluster import contingency_matrix
 from sklearn.metrics import adjusted_rand_score
@@ -15,9 +26,9 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 from datetime import datetime
-from paper_visuals.similarities import compute_dissimilarity_between_groups, visualize_similarity, calculate_group_averages
+from paper_visuals.similarities import compute_dissimilarity_between_groups, visualize_similarity, calculate_group_averages, group_permutation_test
 
-from src.svm import run_svm_classification
+from src.svm import run_svm_classification, permutation_test
 
 
 # Write subject information into new CSV file
@@ -28,6 +39,27 @@ def write_current():
     subject_manager.load_subject_data()
     subject_manager.save_subjects_to_csv("./matrix_subjects.csv")
 
+# Run an entry point with the instrumentation selected in config.py
+# Every entry point starts from fresh counters and writes its own files, prefixed with its name
+def run_entry_point(func, *args, **kwargs):
+    prefix = func.__name__
+    if config.instrument:
+        instrument.enable()
+        instrument.reset()
+    if config.profile:
+        result = instrument.profile(func, *args, output_file=f'{prefix}_profile.prof', **kwargs)
+    else:
+        result = func(*args, **kwargs)
+    if config.instrument:
+        instrument.report()
+        instrument.export_chrome_trace(f'{prefix}_trace.json')
+        instrument.export_json(f'{prefix}_instrument.json')
+    if config.memory_tracking:
+        memory.report()
+    # Headless figures are still rendering in the background
+    figures.wait()
+    return result
+
 # Subfunction to print subject information
 def print_subject_info(subject_manager):
     # Get subjects belonging to a specific group
@@ -77,23 +109,34 @@ def load_content():
 
 # Generate barcode representation of the network
 def generate_barcode(subject_manager):
-    for subject in subject_manager.subjects:
-        # Set the barcode mode to config values
-        barcode = get_barcode(subject.data, barcode_mode=config.barcode_mode, adj_mode=config.adj_mode)
-        # plot_barcode(barcode)
-        subject.set_barcode(barcode)
-        # print(subject)
+    with memory.stage("generate_barcode"):
+        for subject in subject_manager.subjects:
+            # Set the barcode mode to config values
+            barcode = get_barcode(subject.data, barcode_mode=config.barcode_mode, adj_mode=config.adj_mode)
+            # plot_barcode(barcode)
+            subject.set_barcode(barcode)
+            # print(subject)
         
 # Plot the barcode of a single subject
-def plot_single_barcode(subject):
+def plot_single_barcode(subject, max_bars=None):
     barcode_data = subject.barcode
     if config.barcode_mode == "component":
-        plot_component_barcode(barcode_data, "Component Barcode: " + subject.subject_id)
+        plot_component_barcode(barcode_data, "Component Barcode: " + subject.subject_id, max_bars=max_bars)
     elif config.barcode_mode == "cycle":
-        plot_cycle_barcode(barcode_data, "Cycle Barcode: " + subject.subject_id)
+        plot_cycle_barcode(barcode_data, "Cycle Barcode: " + subject.subject_id, max_bars=max_bars)
     else:
-        plot_component_barcode(barcode_data, "Component Barcode: " + subject.subject_id)
-        plot_cycle_barcode(barcode_data, "Cycle Barcode: " + subject.subject_id)
+        births, deaths = split_barcode(barcode_data)
+        plot_component_barcode(births, "Component Barcode: " + subject.subject_id, max_bars=max_bars)
+        plot_cycle_barcode(deaths, "Cycle Barcode: " + subject.subject_id, max_bars=max_bars)
+
+# Write the barcode plots of the whole cohort to files (attached barcode mode)
+def export_barcodes(subject_manager, out_dir=None, max_bars=20000):
+    generate_barcode(subject_manager=subject_manager)
+    if out_dir is None:
+        out_dir = os.path.join(config.results_dir, 'barcodes')
+    paths = export_cohort_barcodes(subject_manager, out_dir, max_bars=max_bars)
+    figures.wait()
+    print(f"Wrote {len(paths)} barcode plots to {out_dir}")
 
 # Calculate the purity score
 def purity_score(labels_true, labels_pred):
@@ -113,7 +156,12 @@ def get_cluster_number():
 
 # Grid search for the best parameters
 # Only deal with learning_rate and topo_relative_weight
-def grid_search_centroids(subject_manager):
+# The line search optimizer finds its own step size, so it only needs a single starting rate
+# With coreset_size, every cell is fitted on a weighted coreset of that many draws (one per
+# topo relative weight) and scored on the full cohort, then the best cell is refit on all subjects
+# With a distance backend (see src/backends.py) the pairwise distances are computed once and
+# only the topo relative weight is searched, the learning rate does not apply
+def grid_search_centroids(subject_manager, optimizer="gd", coreset_size=None, backend="k_centroids"):
     # Default variables
     max_iter_alt = 300
     max_iter_interp = 300
@@ -126,17 +174,45 @@ def grid_search_centroids(subject_manager):
     # Define the range of values for learning_rate and top_relative_weight
     learning_rate_range = [0.01, 0.02, 0.03, 0.05, 0.07, 0.1, 0.12, 0.15, 0.2, 0.3]  # From 0.01 to 0.2
     topo_relative_weight_range = [0.01, 0.05, 0.1, 0.15, 0.25, 0.35, 0.4, 0.5, 0.65, 0.75, 0.85, 0.95, 0.97, 0.99]  # From 0.1 to 0.99
+    if optimizer == "line_search":
+        learning_rate_range = [0.05]
+    if backend != "k_centroids":
+        if coreset_size is not None:
+            raise ValueError("coreset_size only applies to the k_centroids backend")
+        learning_rate_range = [0.05]
+        distances = compute_topological_distances(subject_manager)
 
     labels_true = subject_manager.get_labels()
     best_ari = -1  # Start with the worst possible score
     best_params = None
     results = np.zeros((len(learning_rate_range), len(topo_relative_weight_range)))  # To store ARI scores
 
+    if coreset_size is not None:
+        X = np.asarray([subject.barcode for subject in subject_manager.subjects])
+        coresets = {}
+        for trw in topo_relative_weight_range:
+            indices, weights = build_coreset(X, src.clustering.topological_weight_array(trw, X.shape[1]),
+                                             n_clusters, coreset_size, random_state=config.random_seed)
+            coreset_loader = copy.copy(subject_manager)
+            coreset_loader.subjects = [subject_manager.subjects[index] for index in indices]
+            coresets[trw] = (coreset_loader, weights)
+
     for i, lr in enumerate(learning_rate_range):
         for j, trw in enumerate(topo_relative_weight_range):
             labels_pred = np.random.randint(0, 2, len(labels_true))  # Example random predictions
-            clustering_model = src.clustering.k_centroids_clustering(subject_manager, n_clusters, trw, max_iter_alt, max_iter_interp, lr)
-            labels_pred = clustering_model.fit_predict()
+            if backend != "k_centroids":
+                labels_pred = cluster_with_backend(backend, distances.combine(top_relative_weight=trw), n_clusters,
+                                                   random_state=config.random_seed)
+            elif coreset_size is not None:
+                coreset_loader, weights = coresets[trw]
+                clustering_model = src.clustering.k_centroids_clustering(coreset_loader, n_clusters, trw, max_iter_alt, max_iter_interp, lr,
+                                                                         optimizer=optimizer, sample_weight=weights)
+                clustering_model.fit_predict()
+                labels_pred = clustering_model.predict(X)
+            else:
+                clustering_model = src.clustering.k_centroids_clustering(subject_manager, n_clusters, trw, max_iter_alt, max_iter_interp, lr,
+                                                                         optimizer=optimizer)
+                labels_pred = clustering_model.fit_predict()
             ari_score = adjusted_rand_score(labels_true, labels_pred)
             results[i, j] = ari_score
             
@@ -145,6 +221,13 @@ def grid_search_centroids(subject_manager):
                 best_params = (lr, trw)
             print(f"Learning Rate: {lr}, Topo Relative Weight: {trw}, ARI: {ari_score}")
 
+    if coreset_size is not None:
+        # Refit the winning configuration on the full cohort
+        clustering_model = src.clustering.k_centroids_clustering(subject_manager, n_clusters, best_params[1], max_iter_alt,
+                                                                 max_iter_interp, best_params[0], optimizer=optimizer)
+        best_ari = adjusted_rand_score(labels_true, clustering_model.fit_predict())
+        print(f"Full cohort refit of the best coreset configuration, ARI: {best_ari}")
+
     # Log the best configuration
     logging.info(f"Best ARI: {best_ari} with Learning Rate: {best_params[0]} and Topo Relative Weight: {best_params[1]}")
     logging.info(f"Separation_mode: {config.separation_mode}, Adjacency Matrix Mode: {config.adj_mode}, Labeling Mode: {config.label_mode}")
@@ -160,15 +243,20 @@ def grid_search_centroids(subject_manager):
     current_time = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     filename = f'Grid_Search_Results_ARI_Score_{current_time}_{config.label_mode}_{config.separation_mode}.png'
 
-    # Save the figure
-    plt.savefig(filename, dpi=300, bbox_inches='tight')
-
-    plt.show()
+    # Save the figure, in the background in headless mode
+    fig = plt.gcf()
+    figures.export(fig, filename, dpi=300, bbox_inches='tight')
+    if not config.headless:
+        plt.show()
+    else:
+        plt.close(fig)
 
     return best_params, best_ari
 
+# init selects the seeding of the centroids ("random", "kmeans++" or "greedy_kmeans++"),
+# the average number of alternating iterations is printed to compare them
 def random_seed_search(subject_manager, n_clusters, topo_relative_weight, max_iter_alt,
-                                                    max_iter_interp, learning_rate):
+                                                    max_iter_interp, learning_rate, init="random"):
     # Assuming config.random_seed is a list of seeds
     best_ari_score = -1  # Start with the worst possible score
     best_labels_pred = None
@@ -178,18 +266,23 @@ def random_seed_search(subject_manager, n_clusters, topo_relative_weight, max_it
     
     sum_aris = 0
     aris_list = []
+    iterations_list = []
+    # Seeds often revisit the same partitions, share the centroid updates between them
+    centroid_cache = CentroidCache(maxsize=1024)
     for seed in range(100):
         config.random_seed = seed
         # Create the clustering model with the current seed
         clustering_model = src.clustering.k_centroids_clustering(subject_manager, n_clusters, topo_relative_weight, max_iter_alt,
-                                                    max_iter_interp, learning_rate)
+                                                    max_iter_interp, learning_rate,
+                                                    centroid_cache=centroid_cache, init=init)
         
         # Fit and predict
         labels_pred = clustering_model.fit_predict()
         
         # Calculate ARI score
         ari_score = adjusted_rand_score(labels_true, labels_pred)
-        print(f'Random Seed: {seed}, Adjusted Rand Index: {ari_score}')
+        print(f'Random Seed: {seed}, Adjusted Rand Index: {ari_score}, Iterations: {clustering_model.n_iter}')
+        iterations_list.append(clustering_model.n_iter)
         
         # Update best ARI score, labels, and seed if current ARI is better
         if ari_score > best_ari_score:
@@ -204,6 +297,8 @@ def random_seed_search(subject_manager, n_clusters, topo_relative_weight, max_it
     print('Best Seed:', best_seed)
     print('Average ARI:', sum_aris / 100)
     print('variance:', np.var(aris_list))
+    print('Average iterations:', np.mean(iterations_list))
+    print(centroid_cache.summary())
     #print('Best Labels Predicted:', best_labels_pred)
     #print('Labels True:', best_labels_true)
     logging.info(f"Best ARI: {best_ari_score} with Random Seed: {best_seed}")
@@ -217,7 +312,69 @@ def iter_search(subject_manager):
         ari_score = adjusted_rand_score(labels_true, labels_pred)
         print(f'Max Iteration Num: {max_iter}, Adjusted Rand Index: {ari_score}')
 
-def k_centroids_test(subject_manager):
+# Compare the geometric + topological clustering with the topology-only clustering
+# The topology-only barcodes are half as wide and their centroids need no interpolation
+def compare_geo_modes(subject_manager, topo_relative_weight=0.25, max_iter_alt=300, max_iter_interp=300,
+                      learning_rate=0.05):
+    n_clusters = get_cluster_number()
+    labels_true = subject_manager.get_labels()
+    saved_geo_mode = config.geo_mode
+    try:
+        for geo_mode in ["geo_included", "topo"]:
+            config.geo_mode = geo_mode
+            generate_barcode(subject_manager)
+            clustering_model = src.clustering.k_centroids_clustering(subject_manager, n_clusters, topo_relative_weight,
+                                                                     max_iter_alt, max_iter_interp, learning_rate)
+            start = datetime.now()
+            labels_pred = clustering_model.fit_predict()
+            seconds = (datetime.now() - start).total_seconds()
+            ari_score = adjusted_rand_score(labels_true, labels_pred)
+            print(f"Geo Mode: {geo_mode}, Features: {subject_manager.subjects[0].barcode.shape[0]}, "
+                  f"Adjusted Rand Index: {ari_score}, Iterations: {clustering_model.n_iter}, Time: {seconds:.2f} s")
+    finally:
+        config.geo_mode = saved_geo_mode
+        generate_barcode(subject_manager)
+
+# Mini-batch clustering of a cohort too large to hold all its barcodes in memory
+# The barcodes are written once to a memory-mapped feature store, then read batch by batch
+def k_centroids_minibatch_test(subject_manager, store_path='features.npy', batch_size=32):
+    n_clusters = get_cluster_number()
+    store = FeatureStore.create(store_path, subject_manager, barcode_mode=config.barcode_mode,
+                                adj_mode=config.adj_mode)
+    clustering_model = minibatch_k_centroids_clustering(store, n_clusters, 0.25, 300, 300, 0.05,
+                                                        batch_size=batch_size)
+    labels_pred = clustering_model.fit_predict()
+    ari_score = adjusted_rand_score(store.get_labels(), labels_pred)
+    print(f'Mini-batch Iterations: {clustering_model.n_iter}, Adjusted Rand Index: {ari_score}')
+
+# Runs a distance backend (see src/backends.py) over seeds and cluster counts
+# The pairwise distances are computed once and shared by every run; ARI and purity are
+# reported per cluster count together with the time per fit, to compare with k_centroids
+def backend_search(subject_manager, backend, topo_relative_weight, n_clusters_range=None, n_seeds=100):
+    labels_true = subject_manager.get_labels()
+    if n_clusters_range is None:
+        n_clusters_range = [get_cluster_number()]
+
+    start = datetime.now()
+    distances = compute_topological_distances(subject_manager).combine(top_relative_weight=topo_relative_weight)
+    print(f"Topological distances computed in {(datetime.now() - start).total_seconds():.2f}s")
+
+    for n_clusters in n_clusters_range:
+        aris_list = []
+        purities_list = []
+        start = datetime.now()
+        for seed in range(n_seeds):
+            labels_pred = cluster_with_backend(backend, distances, n_clusters, random_state=seed)
+            aris_list.append(adjusted_rand_score(labels_true, labels_pred))
+            purities_list.append(purity_score(labels_true, labels_pred))
+        seconds = (datetime.now() - start).total_seconds() / n_seeds
+        best_seed = int(np.argmax(aris_list))
+        print(f"Backend: {backend}, Clusters: {n_clusters}, Best ARI: {aris_list[best_seed]} (seed {best_seed}), "
+              f"Average ARI: {np.mean(aris_list)}, Average purity: {np.mean(purities_list)}, Seconds per fit: {seconds:.4f}")
+        logging.info(f"Backend: {backend}, Clusters: {n_clusters}, Best ARI: {aris_list[best_seed]} with Random Seed: {best_seed}")
+
+# backend is "k_centroids" or one of the distance backends of src/backends.py
+def k_centroids_test(subject_manager, backend="k_centroids"):
     # Topological clustering variables
     generate_barcode(subject_manager=subject_manager)    
     n_clusters = get_cluster_number()
@@ -227,6 +384,12 @@ def k_centroids_test(subject_manager):
     learning_rate = 0.05
     topo_relative_weight = 0.25  # 'topo_relative_weight' between 0 and 1
 
+    if backend != "k_centroids":
+        if backend not in BACKENDS:
+            raise ValueError(f"Clustering backend {backend} not supported")
+        backend_search(subject_manager, backend, topo_relative_weight)
+        return
+
     # Single test flag for single parameter testing
     single_test = 0
     if single_test == 1:
@@ -248,13 +411,20 @@ def k_centroids_test(subject_manager):
         # iter_search(subject_manager)
         # clustering_model = src.clustering.k_centroids_clustering(subject_manager, n_clusters, topo_relative_weight, max_iter_alt, max_iter_interp, learning_rate)
 
-def similarity_score():
+# The group averages stream the matrices from disk, the cohort is never loaded at once
+# With n_permutations, the dissimilarities are also tested against label shuffles
+def similarity_score(n_permutations=0):
     subject_manager = SubjectLoader()
-    subject_manager.load_subject_data()
     subject_manager.mci_correct()
-    group_averages = calculate_group_averages(subject_manager.subjects, config.adj_mode)
-    #print_subject_info(subject_manager)
-    dissimilarity_matrix, groups = compute_dissimilarity_between_groups(group_averages)
+    if n_permutations:
+        # The permutation test computes the observed dissimilarities in the same pass
+        result = group_permutation_test(subject_manager.subjects, config.adj_mode, n_permutations=n_permutations,
+                                        random_state=config.random_seed)
+        dissimilarity_matrix, groups = result['observed'], result['groups']
+    else:
+        group_averages = calculate_group_averages(subject_manager.subjects, config.adj_mode)
+        #print_subject_info(subject_manager)
+        dissimilarity_matrix, groups = compute_dissimilarity_between_groups(group_averages)
     cn_average_dissimilarity = np.mean(dissimilarity_matrix[0])
     print(f"Average Dissimilarity of CN group: {cn_average_dissimilarity}")
     emci_average_dissimilarity = np.mean(dissimilarity_matrix[1])
@@ -265,6 +435,11 @@ def similarity_score():
     print(f"Average Dissimilarity of AD group: {ad_average_dissimilarity}")
     print(dissimilarity_matrix)
 
+    if n_permutations:
+        print("Permutation test groups:", result['groups'])
+        print("P-values:")
+        print(result['p_values'])
+
 def svm_classification_grid_l1(subject_loader, l1, l2):
     for subject in subject_loader.subjects:
         # Set the barcode mode to config values
@@ -363,6 +538,17 @@ def svm_classification(subject_loader, l1, l2):
 
     print(f"Average Cross-Validation Score: {results['average_score']}")
     print(f"Cross-Validation Scores for Each Fold: {results['cv_scores']}") 
+
+def svm_permutation_test(subject_loader, n_permutations=1000):
+    
+    for subject in subject_loader.subjects:
+        # Set the barcode mode to config values
+        barcode = get_barcode(subject.data, barcode_mode=config.barcode_mode, adj_mode=config.adj_mode, l = 0.5)
+        subject.set_barcode(barcode)
+    results = permutation_test(subject_loader.subjects, n_permutations, c_value = 1, cv_folds=5, random_state = 0)
+
+    print(f"Average Cross-Validation Score: {results['average_score']}")
+    print(f"Permutation p-value ({n_permutations} permutations): {results['p_value']}")
     
 if __name__ == '__main__':
     print(
@@ -378,8 +564,8 @@ if __name__ == '__main__':
     # similarity_score()
 
     # The following code tests the k-centroids clustering algorithm
-    subject_manager = load_content()
-    k_centroids_test(subject_manager)  
+    subject_manager = run_entry_point(load_content)
+    run_entry_point(k_centroids_test, subject_manager)
 
 
 
@@ -389,5 +575,6 @@ if __name__ == '__main__':
     l1 = 1
     l2 = 1
     # svm_classification(subject_manager, l1, l2)
+    # svm_permutation_test(subject_manager, n_permutations=1000)
 
     
\ No newline at end of file
@@ -1,6 +1,13 @@
+import os
 import numpy as np
+import config
+import src.memory as memory
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
 import matplotlib.pyplot as plt
+import src.figures as figures
 from scipy.spatial.distance import pdist, squareform
+from src.accumulators import RunningStats
 
 
 def set_mode(adj, mode='original'):
@@ -10,37 +17,195 @@ def set_mode(adj, mode='original'):
         adj = np.abs(adj)
     return adj
 
-def calculate_group_averages(subjects, input_mode='original'):
+def iter_subject_matrices(subjects, data_dir=None):
     """
-    Calculate the average adjacency matrix for each group.
+    Yield every subject with its adjacency matrix, reading it from disk when it is not
+    loaded, without keeping it on the subject. Subjects without a data file are skipped.
     """
-    mode = input_mode
-    group_matrices = {'AD': [], 'LMCI': [], 'EMCI': [], 'CN': []}
+    data_dir = config.data_dir if data_dir is None else data_dir
     for subject in subjects:
-        group_matrices[subject.group].append(set_mode(subject.data, mode))
-    
+        if subject.data is not None:
+            yield subject, subject.data
+            continue
+        file_path = os.path.join(data_dir, f"sub-{subject.subject_id}.npy")
+        if os.path.exists(file_path):
+            yield subject, np.load(file_path)
+
+def calculate_group_statistics(subjects, input_mode='original', track_variance=False):
+    """
+    Stream the adjacency matrices of the subjects into one RunningStats per group.
+
+    Only one matrix is in memory at a time, so the cohort can be of any size.
+    """
+    group_stats = {}
+    for subject, data in iter_subject_matrices(subjects):
+        if subject.group not in group_stats:
+            group_stats[subject.group] = RunningStats(data.shape, track_variance=track_variance)
+        group_stats[subject.group].add(set_mode(data, input_mode))
+    return group_stats
+
+def calculate_group_averages(subjects, input_mode='original', track_variance=False):
+    """
+    Calculate the average adjacency matrix for each group, in one streaming pass.
+    With track_variance, also return the element-wise variance of each group.
+    """
+    group_stats = calculate_group_statistics(subjects, input_mode, track_variance)
     group_averages = {}
-    for group, matrices in group_matrices.items():
-        group_averages[group] = np.mean(matrices, axis=0)
+    group_variances = {}
+    for group in ['AD', 'LMCI', 'EMCI', 'CN']:
+        if group in group_stats:
+            group_averages[group] = group_stats[group].mean()
+            if track_variance:
+                group_variances[group] = group_stats[group].variance()
+        else:
+            # Same as the mean of an empty group
+            group_averages[group] = np.nan
+            group_variances[group] = np.nan
     
+    if track_variance:
+        return group_averages, group_variances
     return group_averages
 
 def compute_dissimilarity_between_groups(group_averages):
     """
-    Compute the dissimilarity between each pair of group averages.
+    Compute the Frobenius dissimilarity between each pair of group averages, as the
+    Euclidean distances between the flattened averages.
     """
     groups = list(group_averages.keys())
-    dissimilarity_matrix = np.zeros((len(groups), len(groups)))
-    
-    for i, group1 in enumerate(groups):
-        for j, group2 in enumerate(groups):
-            if i <= j:  # Compute only for one triangle and mirror it as the matrix is symmetric
-                dissimilarity = np.linalg.norm(group_averages[group1] - group_averages[group2], 'fro')
-                dissimilarity_matrix[i, j] = dissimilarity
-                dissimilarity_matrix[j, i] = dissimilarity
+    shape = next((np.shape(average) for average in group_averages.values() if np.ndim(average)), ())
+    stacked = np.array([np.broadcast_to(group_averages[group], shape).ravel() for group in groups])
+    dissimilarity_matrix = squareform(pdist(stacked))
                 
     return dissimilarity_matrix, groups
 
+def upper_triangle_features(subjects, input_mode='original'):
+    """
+    Stack the upper triangles (k = 1) of the subjects' adjacency matrices, streamed from disk.
+
+    The Frobenius distance between symmetric matrices is sqrt(2) times the distance
+    between their upper triangles, plus the diagonal term. The diagonal is only kept
+    (as extra columns, with weights) when it differs between subjects.
+
+    Returns:
+        tuple: The (n_subjects, n_features) matrix, the weight of every column in the
+            squared distance, and the group of every row.
+    """
+    subjects = list(subjects)
+    X = None
+    diagonals = None
+    groups = []
+    for subject, data in iter_subject_matrices(subjects):
+        data = set_mode(data, input_mode)
+        if X is None:
+            n_node = data.shape[0]
+            upper = np.triu_indices(n_node, k=1)
+            memory.require("upper_triangle_features", len(subjects) * (len(upper[0]) + n_node) * 8)
+            X = np.empty((len(subjects), len(upper[0])))
+            diagonals = np.empty((len(subjects), n_node))
+        X[len(groups)] = data[upper]
+        diagonals[len(groups)] = np.diag(data)
+        groups.append(subject.group)
+    if X is None:
+        raise ValueError(f"No adjacency matrix found for the {len(subjects)} subjects, "
+                         f"neither loaded nor in {config.data_dir}")
+    X, diagonals = X[:len(groups)], diagonals[:len(groups)]
+
+    weights = np.full(X.shape[1], 2.0)
+    if not np.allclose(diagonals, diagonals[0], rtol=0, atol=1e-12):
+        X = np.hstack((X, diagonals))
+        weights = np.concatenate((weights, np.ones(diagonals.shape[1])))
+    return X, weights, np.array(groups)
+
+# State shared with the permutation workers, set once per process by the pool initializer
+_permutation_state = None
+
+def _init_permutation_worker(X, weights, codes, n_groups):
+    global _permutation_state
+    _permutation_state = (X, weights, codes, n_groups)
+
+def _group_dissimilarities(label_sets):
+    """
+    Pairwise group dissimilarities for a batch of label vectors, (n_sets, n_groups, n_groups).
+
+    The group means of all label vectors come from one sparse indicator product:
+    row (b, g) of the indicator holds 1 / n_g on the subjects of group g in label vector b.
+    """
+    X, weights, codes, n_groups = _permutation_state
+    n_sets, n_subjects = label_sets.shape
+    counts = np.bincount(codes, minlength=n_groups)
+    rows = (np.arange(n_sets)[:, None] * n_groups + label_sets).ravel()
+    cols = np.tile(np.arange(n_subjects), n_sets)
+    indicator = csr_matrix((1 / counts[label_sets.ravel()], (rows, cols)), shape=(n_sets * n_groups, n_subjects))
+    means = (indicator @ X).reshape(n_sets, n_groups, -1)
+
+    dissimilarities = np.zeros((n_sets, n_groups, n_groups))
+    for g in range(n_groups):
+        for h in range(g + 1, n_groups):
+            dissimilarities[:, g, h] = np.sqrt(np.dot((means[:, g] - means[:, h])**2, weights))
+            dissimilarities[:, h, g] = dissimilarities[:, g, h]
+    return dissimilarities
+
+def _permutation_batch(seed, n_permutations, chunk_size):
+    _, _, codes, _ = _permutation_state
+    rng = np.random.default_rng(seed)
+    label_sets = np.array([rng.permutation(codes) for _ in range(n_permutations)])
+    return np.concatenate([_group_dissimilarities(label_sets[start:start + chunk_size])
+                           for start in range(0, n_permutations, chunk_size)])
+
+def group_permutation_test(subjects, input_mode='original', n_permutations=1000, batch_size=200,
+                           chunk_size=50, random_state=0, n_jobs=None):
+    """
+    Label permutation test for the dissimilarities of compute_dissimilarity_between_groups.
+
+    The upper triangles of the subjects are stacked once; every shuffle of the group labels
+    only changes a sparse indicator matrix whose product with them gives the shuffled group
+    means. Shuffles are drawn in batches that run on a process pool, each batch evaluated
+    chunk_size shuffles at a time to bound the memory of the means.
+
+    Parameters:
+    - subjects: Subjects with their group, data loaded or on disk.
+    - input_mode: Adjacency mode of set_mode.
+    - n_permutations: Number of label shuffles in the null distributions.
+    - batch_size: Number of shuffles per task.
+    - chunk_size: Number of shuffles whose group means are computed at once.
+    - random_state: Seed of the shuffles.
+    - n_jobs: Number of worker processes, defaults to the number of CPUs. 1 runs in-process.
+
+    Returns:
+    - A dictionary with the groups, the observed dissimilarity matrix, the null
+      distribution of every entry (n_permutations, n_groups, n_groups) and the p-values.
+    """
+    X, weights, labels = upper_triangle_features(subjects, input_mode)
+    groups = [group for group in ['AD', 'LMCI', 'EMCI', 'CN'] if group in set(labels)]
+    codes = np.array([groups.index(label) for label in labels])
+
+    _init_permutation_worker(X, weights, codes, len(groups))
+    observed = _group_dissimilarities(codes[None, :])[0]
+
+    # One independent stream per batch, so the result does not depend on n_jobs
+    batch_sizes = [min(batch_size, n_permutations - start) for start in range(0, n_permutations, batch_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(batch_sizes))
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1:
+        batches = [_permutation_batch(seed, size, chunk_size) for seed, size in zip(seeds, batch_sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_permutation_worker,
+                                 initargs=(X, weights, codes, len(groups))) as executor:
+            batches = list(executor.map(_permutation_batch, seeds, batch_sizes, [chunk_size] * len(batch_sizes)))
+
+    null_distribution = np.concatenate(batches) if batches else np.empty((0, len(groups), len(groups)))
+    p_values = (np.sum(null_distribution >= observed, axis=0) + 1) / (len(null_distribution) + 1)
+    np.fill_diagonal(p_values, 1)
+
+    return {
+        'groups': groups,
+        'observed': observed,
+        'null_distribution': null_distribution,
+        'p_values': p_values
+    }
+
 def visualize_similarity(similarity_matrix, groups):
     """
     Visualize the similarity matrix with a white background and black font.
@@ -60,4 +225,4 @@ def visualize_similarity(similarity_matrix, groups):
     ax.set_yticklabels(groups)
     
     plt.xticks(rotation=90)
-    plt.show()
+    figures.show(fig, 'group_dissimilarity.png', dpi=300, bbox_inches='tight')
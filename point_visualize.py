@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
@@ -5,7 +6,9 @@ from src.subject import SubjectLoader, Subject
 from main import load_content
 import config
 from src.barcode import get_barcode
-from src.svm import tsne_svm
+from src.distance import compute_topological_distances, tsne_lambda_sweep
+from src.svm import tsne_svm, decision_boundary
+import src.figures as figures
 
 # Function to extract barcode data and labels
 def extract_data(subject_loader, l = 0.5):
@@ -64,7 +67,7 @@ def visualize_data_grid(subject_manager, l_list):
         ax.set_visible(False)
     
     plt.tight_layout()
-    plt.show()
+    figures.show(fig, 'tsne_lambda_grid.png', dpi=150)
 
 # Function to visualize the data
 def visualize_data(data, labels, l):
@@ -82,7 +85,7 @@ def visualize_data(data, labels, l):
         plt.scatter(transformed_data[idx, 0], transformed_data[idx, 1], c=group_color[group], label=group, alpha=0.6)
     plt.title('Topological Feature Visualization by Group' + ' L: ' + str(l))
     plt.legend()
-    plt.show()
+    figures.show(filename=f'tsne_lambda_{l:.4f}.png', dpi=150)
     
 def plot(xx, yy, Z, data_scaled, labels, l):
     # print(Z)
@@ -103,57 +106,11 @@ def plot(xx, yy, Z, data_scaled, labels, l):
         plt.title(f'SVM Decision Boundary(AD vs CN); lambda = {l:.3f})')
     else:
         plt.title(f'SVM Decision Boundary(AD + LMCI vs CN + EMCI); lambda = {l:.4f})')
-    plt.show()
+    figures.show(filename=f'svm_decision_boundary_{config.separation_mode}_lambda_{l:.4f}.png', dpi=150)
 
 
-grid_search = 0
-subject_manager = load_content()
-if grid_search:
-    l_list = np.arange(0.2, 0.3, 0.001)
-    max_ari = 0
-    for l in l_list:
-        data, labels = extract_data(subject_manager, l)
-        # Visualize the data
-        # visualize_data(data, labels, l)
-        tsne = TSNE(n_components=2, random_state=42)
-        transformed_data = tsne.fit_transform(data)
-        temp = []
-        for label in labels:
-            if config.separation_mode == "strict_binary":
-                if label == "AD":
-                    temp.append(0)
-                else:
-                    temp.append(1)
-            elif config.separation_mode == "cn_separation":
-                if label == "CN":
-                    temp.append(1)
-                else:
-                    temp.append(0)
-            elif config.separation_mode == "mixed_separation":
-                if label == "CN" or label == "EMCI":
-                    temp.append(1)
-                else:
-                    temp.append(0)
-        ari_score, xx, yy, Z, data_scaled, _ = tsne_svm(transformed_data, temp, l)
-        if ari_score > max_ari:
-            max_ari = ari_score
-            best_l = l
-            best_xx = xx
-            best_yy = yy
-            best_Z = Z
-            best_data_scaled = data_scaled
-
-    plot(best_xx, best_yy, best_Z, best_data_scaled, temp, best_l)
-else:
-    # max l for strict binary: 
-    # 0.423, 0.462
-    # max l for mixed separation:
-    # 0.261, 0.269
-    l = 0.261
-    data, labels = extract_data(subject_manager, l)
-    # Visualize the data
-    tsne = TSNE(n_components=2, random_state=42)
-    transformed_data = tsne.fit_transform(data)
+# Binary labels of the SVM (1 for the CN side) from the group names
+def binary_labels(labels):
     temp = []
     for label in labels:
         if config.separation_mode == "strict_binary":
@@ -171,5 +128,51 @@ else:
                 temp.append(1)
             else:
                 temp.append(0)
-    ari_score, xx, yy, Z, data_scaled, _ = tsne_svm(transformed_data, temp, l)
-    plot(xx, yy, Z, data_scaled, temp, l)
\ No newline at end of file
+    return temp
+
+# Lambda sweep on precomputed distances
+# The barcodes are computed once (l = 1) and every lambda only reweights the geometric,
+# birth and death distance blocks; t-SNE runs on the precomputed distances, warm-started
+# from the neighbouring lambda, with chunks of lambdas in parallel (see tsne_lambda_sweep)
+def lambda_sweep(subject_manager, l_list, n_jobs=None):
+    data, labels = extract_data(subject_manager, 1)
+    sweep_loader = copy.copy(subject_manager)
+    sweep_loader.subjects = [subject for subject in subject_manager.subjects
+                             if config.separation_mode != "strict_binary" or subject.label in ("AD", "CN")]
+    distances = compute_topological_distances(sweep_loader)
+    embeddings = tsne_lambda_sweep(distances, l_list, n_jobs=n_jobs, random_state=42)
+
+    temp = binary_labels(labels)
+    max_ari = 0
+    best = None
+    for l, transformed_data in zip(l_list, embeddings):
+        ari_score, svc, data_scaled, _ = tsne_svm(transformed_data, temp, l)
+        if ari_score > max_ari:
+            max_ari = ari_score
+            best = (svc, data_scaled, l)
+    return max_ari, best, temp
+
+
+if __name__ == '__main__':
+    grid_search = 0
+    subject_manager = load_content()
+    if grid_search:
+        l_list = np.arange(0.2, 0.3, 0.001)
+        max_ari, (best_svc, best_data_scaled, best_l), temp = lambda_sweep(subject_manager, l_list)
+        # Only the plotted result pays for the decision boundary
+        best_xx, best_yy, best_Z = decision_boundary(best_svc, best_data_scaled)
+        plot(best_xx, best_yy, best_Z, best_data_scaled, temp, best_l)
+    else:
+        # max l for strict binary: 
+        # 0.423, 0.462
+        # max l for mixed separation:
+        # 0.261, 0.269
+        l = 0.261
+        data, labels = extract_data(subject_manager, l)
+        # Visualize the data
+        tsne = TSNE(n_components=2, random_state=42)
+        transformed_data = tsne.fit_transform(data)
+        temp = binary_labels(labels)
+        ari_score, svc, data_scaled, _ = tsne_svm(transformed_data, temp, l)
+        xx, yy, Z = decision_boundary(svc, data_scaled)
+        plot(xx, yy, Z, data_scaled, temp, l)
@@ -0,0 +1,220 @@
+# accumulators.py
+# Running per-cluster sums and counts of feature rows
+# Cluster means are updated from the rows that changed cluster only, so an alternating
+# iteration where few subjects move costs O(moved x features) instead of a full pass
+# RunningStats streams the mean (and optionally the variance) of arrays of any shape,
+# e.g. the group averages of the adjacency matrices, without keeping the arrays
+# Author: Boqian Shi
+
+import numpy as np
+
+
+class ClusterAccumulator:
+    """
+    Per-cluster sufficient statistics (sum and count) of feature rows, optionally
+    weighted, in which case the counts are total weights.
+
+    Rows can be added and removed one batch at a time, or a whole cohort can be
+    reassigned with update(), which only touches the rows whose cluster changed.
+    Sums drift from an exact pass by rounding only; refresh_every bounds the drift by
+    recomputing them from scratch every given number of updates.
+
+    Args:
+        n_clusters (int): Number of clusters.
+        n_features (int): Width of the rows.
+        dtype (numpy.dtype): Data type of the sums.
+        refresh_every (int, optional): Recompute the sums exactly every refresh_every
+            calls of update(), never by default.
+    """
+
+    def __init__(self, n_clusters, n_features, dtype=np.float64, refresh_every=None):
+        self.n_clusters = n_clusters
+        self.n_features = n_features
+        self.refresh_every = refresh_every
+        self.sums = np.zeros((n_clusters, n_features), dtype=dtype)
+        self.counts = np.zeros(n_clusters, dtype=np.int64)
+        self.labels = None
+        self.sample_weight = None
+        self.n_updates = 0
+        self.n_moved = 0
+
+    def fit(self, X, labels, sample_weight=None):
+        """
+        Computes the statistics of a labelled set of rows from scratch.
+
+        Args:
+            X (numpy.ndarray): Rows (n_samples, n_features).
+            labels (numpy.ndarray): Cluster index of every row.
+            sample_weight (numpy.ndarray, optional): Weight of every row, also used by
+                the later update() calls.
+
+        Returns:
+            ClusterAccumulator: self.
+        """
+        labels = np.asarray(labels)
+        if sample_weight is not None:
+            self.sample_weight = np.asarray(sample_weight, dtype=self.sums.dtype)
+            self.counts = self.counts.astype(self.sums.dtype)
+        for cluster in range(self.n_clusters):
+            in_cluster = labels == cluster
+            if self.sample_weight is None:
+                self.counts[cluster] = np.count_nonzero(in_cluster)
+                self.sums[cluster] = X[in_cluster].sum(axis=0)
+            else:
+                self.counts[cluster] = self.sample_weight[in_cluster].sum()
+                self.sums[cluster] = np.dot(self.sample_weight[in_cluster], X[in_cluster])
+        self.labels = labels.copy()
+        self.n_updates = 0
+        return self
+
+    def add(self, rows, labels, weights=None):
+        """
+        Adds rows to their clusters, e.g. while streaming subjects from disk.
+
+        Args:
+            rows (numpy.ndarray): Rows (n_rows, n_features), or a single row.
+            labels (int or numpy.ndarray): Cluster index of every row.
+            weights (numpy.ndarray, optional): Weight of every row.
+        """
+        self._accumulate(rows, labels, 1, weights)
+
+    def remove(self, rows, labels, weights=None):
+        """
+        Removes rows previously added to their clusters.
+
+        Args:
+            rows (numpy.ndarray): Rows (n_rows, n_features), or a single row.
+            labels (int or numpy.ndarray): Cluster index of every row.
+            weights (numpy.ndarray, optional): Weight of every row, as when it was added.
+        """
+        self._accumulate(rows, labels, -1, weights)
+
+    def _accumulate(self, rows, labels, sign, weights=None):
+        rows = np.atleast_2d(rows)
+        labels = np.broadcast_to(labels, rows.shape[:1])
+        if weights is not None:
+            weights = np.broadcast_to(weights, rows.shape[:1])
+            if not np.issubdtype(self.counts.dtype, np.floating):
+                self.counts = self.counts.astype(self.sums.dtype)
+        for cluster in np.unique(labels):
+            in_cluster = labels == cluster
+            if weights is None:
+                total = rows[in_cluster].sum(axis=0)
+                count = np.count_nonzero(in_cluster)
+            else:
+                total = np.dot(weights[in_cluster], rows[in_cluster])
+                count = weights[in_cluster].sum()
+            if sign > 0:
+                self.sums[cluster] += total
+            else:
+                self.sums[cluster] -= total
+            self.counts[cluster] += sign * count
+
+    def update(self, X, labels):
+        """
+        Reassigns the rows of the set given to fit(), moving only the rows whose
+        cluster changed.
+
+        Args:
+            X (numpy.ndarray): The rows given to fit().
+            labels (numpy.ndarray): New cluster index of every row.
+
+        Returns:
+            numpy.ndarray: Indices of the rows that moved.
+        """
+        labels = np.asarray(labels)
+        self.n_updates += 1
+        if self.refresh_every is not None and self.n_updates % self.refresh_every == 0:
+            moved = np.flatnonzero(self.labels != labels)
+            n_updates = self.n_updates
+            self.fit(X, labels, self.sample_weight)
+            self.n_updates = n_updates
+        else:
+            moved = np.flatnonzero(self.labels != labels)
+            if len(moved):
+                weights = None if self.sample_weight is None else self.sample_weight[moved]
+                self.remove(X[moved], self.labels[moved], weights)
+                self.add(X[moved], labels[moved], weights)
+            self.labels = labels.copy()
+        self.n_moved += len(moved)
+        return moved
+
+    def mean(self, cluster):
+        """
+        Mean row of a cluster, NaN for an empty cluster.
+
+        Args:
+            cluster (int): Cluster index.
+
+        Returns:
+            numpy.ndarray: Mean of the rows of the cluster.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums[cluster] / self.counts[cluster]
+
+    def means(self):
+        """Mean rows of all clusters (n_clusters, n_features)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums / self.counts[:, None]
+
+
+class RunningStats:
+    """
+    Streaming mean, and optionally variance, of equally shaped arrays.
+
+    Without variance the mean is the running sum divided by the count, which gives the
+    same result as np.mean over the stacked arrays. With track_variance, Welford's update
+    keeps the mean and the sum of squared deviations numerically stable in one pass.
+
+    Args:
+        shape (tuple): Shape of the arrays.
+        dtype (numpy.dtype): Data type of the statistics.
+        track_variance (bool): Also accumulate the variance.
+    """
+
+    def __init__(self, shape, dtype=np.float64, track_variance=False):
+        self.track_variance = track_variance
+        self.count = 0
+        if track_variance:
+            self._mean = np.zeros(shape, dtype=dtype)
+            self._m2 = np.zeros(shape, dtype=dtype)
+        else:
+            self._sum = np.zeros(shape, dtype=dtype)
+
+    def add(self, x):
+        """
+        Adds one array.
+
+        Args:
+            x (numpy.ndarray): Array of the accumulated shape.
+        """
+        self.count += 1
+        if self.track_variance:
+            delta = x - self._mean
+            self._mean += delta / self.count
+            self._m2 += delta * (x - self._mean)
+        else:
+            self._sum += x
+
+    def mean(self):
+        """Mean of the added arrays, NaN before the first one."""
+        if self.track_variance:
+            return self._mean.copy() if self.count else np.full_like(self._mean, np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._sum / self.count
+
+    def variance(self, ddof=0):
+        """
+        Variance of the added arrays.
+
+        Args:
+            ddof (int): Delta degrees of freedom, 1 for the sample variance.
+
+        Returns:
+            numpy.ndarray: Element-wise variance, NaN without enough arrays.
+        """
+        if not self.track_variance:
+            raise ValueError("RunningStats created without track_variance")
+        if self.count - ddof <= 0:
+            return np.full_like(self._m2, np.nan)
+        return self._m2 / (self.count - ddof)
@@ -0,0 +1,114 @@
+# backends.py
+# Clustering backends working on precomputed topological distances
+# Much cheaper than k_centroids_clustering for screening configurations: the pairwise
+# distances are computed once (src/distance.py) and reused across seeds and cluster counts
+# Author: Boqian Shi
+
+import numpy as np
+from sklearn.cluster import AgglomerativeClustering, SpectralClustering
+
+
+def k_medoids(distances, n_clusters, random_state=0, max_iter=100):
+    """
+    k-medoids (alternating Voronoi iteration) on a distance matrix.
+
+    Medoids are seeded by k-means++ draws, then every subject is assigned to its nearest
+    medoid and every medoid is replaced by the member minimizing the total distance to
+    its cluster, until the medoids stop changing.
+
+    Args:
+        distances (numpy.ndarray): Squared topological distances (n_samples, n_samples).
+        n_clusters (int): Number of clusters.
+        random_state (int): Seed of the initial medoids.
+        max_iter (int): Maximum number of iterations.
+
+    Returns:
+        numpy.ndarray: Cluster index of every subject.
+    """
+    rng = np.random.default_rng(random_state)
+    n_rows = distances.shape[0]
+    medoids = [rng.integers(n_rows)]
+    for _ in range(1, n_clusters):
+        closest = distances[:, medoids].min(axis=1)
+        total = closest.sum()
+        medoids.append(rng.choice(n_rows, p=closest / total) if total > 0 else rng.integers(n_rows))
+    medoids = np.array(medoids)
+
+    for _ in range(max_iter):
+        labels = np.argmin(distances[:, medoids], axis=1)
+        new_medoids = medoids.copy()
+        for cluster in range(n_clusters):
+            members = np.flatnonzero(labels == cluster)
+            if len(members):
+                new_medoids[cluster] = members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+    return np.argmin(distances[:, medoids], axis=1)
+
+
+def spectral(distances, n_clusters, random_state=0, gamma=None):
+    """
+    Spectral clustering on the affinity kernel exp(-gamma * distances).
+
+    Args:
+        distances (numpy.ndarray): Squared topological distances.
+        n_clusters (int): Number of clusters.
+        random_state (int): Seed of the eigenvector k-means.
+        gamma (float, optional): Kernel width, 1 / median of the off-diagonal distances
+            by default.
+
+    Returns:
+        numpy.ndarray: Cluster index of every subject.
+    """
+    if gamma is None:
+        off_diagonal = distances[~np.eye(distances.shape[0], dtype=bool)]
+        gamma = 1 / max(np.median(off_diagonal), np.finfo(float).tiny)
+    affinity = np.exp(-gamma * distances)
+    return SpectralClustering(n_clusters=n_clusters, affinity='precomputed',
+                              random_state=random_state).fit_predict(affinity)
+
+
+def agglomerative(distances, n_clusters, random_state=0, linkage='average'):
+    """
+    Agglomerative clustering on the topological distances (deterministic, random_state
+    is ignored).
+
+    Args:
+        distances (numpy.ndarray): Squared topological distances.
+        n_clusters (int): Number of clusters.
+        random_state (int): Unused, for a common signature.
+        linkage (str): "average", "complete" or "single".
+
+    Returns:
+        numpy.ndarray: Cluster index of every subject.
+    """
+    return AgglomerativeClustering(n_clusters=n_clusters, metric='precomputed',
+                                   linkage=linkage).fit_predict(np.sqrt(distances))
+
+
+BACKENDS = {
+    'k_medoids': k_medoids,
+    'spectral': spectral,
+    'agglomerative': agglomerative,
+}
+
+
+def cluster_with_backend(backend, distances, n_clusters, random_state=0, **kwargs):
+    """
+    Clusters subjects from their pairwise distances with a registered backend.
+
+    Args:
+        backend (str): Name of the backend, a key of BACKENDS.
+        distances (numpy.ndarray): Squared topological distances, e.g.
+            TopologicalDistances.combine(top_relative_weight).
+        n_clusters (int): Number of clusters.
+        random_state (int): Seed of the backend.
+        **kwargs: Options of the backend.
+
+    Returns:
+        numpy.ndarray: Cluster index of every subject.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Clustering backend {backend} not supported, options: {', '.join(BACKENDS)}")
+    return BACKENDS[backend](distances, n_clusters, random_state=random_state, **kwargs)
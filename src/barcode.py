@@ -2,11 +2,17 @@
 # Functions for generating barcode representation of the network
 # Author: Boqian Shi
 
+import math
 import numpy as np
 import config
+from functools import lru_cache
+import src.instrument as instrument
+import src.memory as memory
 from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import minimum_spanning_tree
+import src.figures as figures
 from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
 
 def bd_decomposition(adj):
     """
@@ -18,6 +24,8 @@ def bd_decomposition(adj):
     Returns:
         tuple: A tuple containing the minimum spanning tree (MST) and the non-MST edges.
     """
+    # triu, the negated copy, the dense MST and the non-MST edges are all dense copies
+    memory.require("bd_decomposition", 4 * adj.nbytes)
     eps = np.nextafter(0, 1)
     adj[adj == 0] = eps
     adj = np.triu(adj, k=1)
@@ -27,6 +35,80 @@ def bd_decomposition(adj):
     nonmst = adj - mst
     return mst, nonmst
 
+def n_node_from_edges(n_edges):
+    """
+    Number of nodes of a complete network with n_edges edges, i.e. n_edges = (n_node choose 2).
+
+    Args:
+        n_edges (int): Number of edges (64620 for the 360-node parcellation).
+
+    Returns:
+        int: Number of nodes.
+    """
+    return (1 + math.isqrt(1 + 8 * n_edges)) // 2
+
+@lru_cache(maxsize=None)
+def _upper_triangle_structure(n_node):
+    """CSR row pointers and column indices of the strict upper triangle, in packed order."""
+    rows, cols = np.triu_indices(n_node, k=1)
+    indptr = np.zeros(n_node + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n_node), out=indptr[1:])
+    indices = cols.astype(np.int32)
+    # Shared between calls, so protect them against in-place scipy routines
+    indptr.setflags(write=False)
+    indices.setflags(write=False)
+    return indptr, indices
+
+def packed_bd_decomposition(vec):
+    """
+    Birth-death decomposition of a network given as its packed upper triangle.
+
+    Gives the same sorted sets as bd_decomposition without building any dense matrix:
+    the upper triangle is handed to the MST as a CSR matrix of fixed structure and the
+    tree edges are mapped back to packed positions.
+
+    Args:
+        vec (numpy.ndarray): Edge weights in np.triu_indices(n_node, k=1) order, without zeros.
+
+    Returns:
+        tuple: Packed indices of the MST edges (births) and of the non-MST edges (deaths),
+            each sorted by increasing weight.
+    """
+    n_node = n_node_from_edges(len(vec))
+    indptr, indices = _upper_triangle_structure(n_node)
+    tree = minimum_spanning_tree(csr_matrix((-vec, indices, indptr), shape=(n_node, n_node))).tocoo()
+    # Position of edge (i, j), i < j, in the row-major upper triangle
+    birth_ind = np.sort(tree.row * (2 * n_node - tree.row - 1) // 2 + tree.col - tree.row - 1)
+    is_death = np.ones(len(vec), dtype=bool)
+    is_death[birth_ind] = False
+    death_ind = np.flatnonzero(is_death)
+    return birth_ind[np.argsort(vec[birth_ind])], death_ind[np.argsort(vec[death_ind])]
+
+def packed_barcode(vec, decomposition=None, adj_mode="ignore_negative"):
+    """
+    Barcode of a network given as its packed upper triangle, same as get_barcode (l = 1).
+
+    Args:
+        vec (numpy.ndarray): Edge weights in np.triu_indices(n_node, k=1) order.
+        decomposition (tuple, optional): Output of packed_bd_decomposition for vec, when
+            the caller already has it; it must have been computed on the weights left after
+            adj_mode and the zero replacement.
+        adj_mode (str): Adjacency matrix mode, see set_mode.
+
+    Returns:
+        numpy.ndarray: The barcode, laid out as in get_barcode.
+    """
+    adj = set_mode(vec, adj_mode)
+    if adj is vec:
+        adj = vec.copy()
+    adj[adj == 0] = np.nextafter(0, 1)
+    if decomposition is None:
+        decomposition = packed_bd_decomposition(adj)
+    birth_ind, death_ind = decomposition
+    if config.geo_mode == "topo":
+        return np.concatenate((adj[birth_ind], adj[death_ind]), axis=0)
+    return np.concatenate((adj, adj[birth_ind], adj[death_ind]), axis=0)
+
 def compute_mst_sets(mst):
     """
     Computes birth sets of a network.
@@ -93,8 +175,10 @@ def get_barcode(adj, barcode_mode = "attached", adj_mode = "ignore_negative", l
     Returns:
         list: A list containing the birth and death sets of the network.
     """
+    instrument.count("barcodes")
     adj = set_mode(adj, adj_mode)
-    mst, nonmst = bd_decomposition(adj)
+    with instrument.timer("bd_decomposition"):
+        mst, nonmst = bd_decomposition(adj)
     if config.geo_mode == "topo":
         # Cycle number 64261
         if barcode_mode == "cycle":
@@ -126,48 +210,136 @@ def get_barcode(adj, barcode_mode = "attached", adj_mode = "ignore_negative", l
 
 
 
+def split_barcode(barcode):
+    """
+    Births and deaths of a barcode from get_barcode (l = 1), with or without the edge weights.
+
+    Args:
+        barcode (numpy.ndarray): Barcode of the "attached" mode.
+
+    Returns:
+        tuple: The births (MST edges) and the deaths (non-MST edges).
+    """
+    n_features = len(barcode)
+    if config.geo_mode == "topo":
+        n_edges = n_features
+    else:
+        n_edges = n_features // 2
+    n_births = n_node_from_edges(n_edges) - 1
+    top = barcode[n_features - n_edges:]
+    return top[:n_births], top[n_births:]
+
+def _downsample_bars(n_bars, max_bars):
+    """
+    Indices of at most max_bars bars, evenly spaced in the barcode.
+
+    Barcodes are sorted, so taking every k-th bar keeps their quantiles: dense ranges of
+    values keep proportionally more bars and the plotted shape does not change.
+    """
+    if max_bars is None or n_bars <= max_bars:
+        return np.arange(n_bars)
+    return np.unique(np.linspace(0, n_bars - 1, max_bars).round().astype(int))
+
+def _plot_bars(starts, ends, title, max_bars=None, ax=None):
+    """
+    Draws the bars of a barcode as one LineCollection, rasterized in vector outputs.
+
+    Bars keep their index in the full barcode, so a downsampled plot spans the same range.
+
+    Returns:
+        matplotlib.figure.Figure: The figure of the plot.
+    """
+    ends = np.asarray(ends)
+    starts = np.broadcast_to(starts, ends.shape)
+    index = _downsample_bars(len(ends), max_bars)
+    segments = np.empty((len(index), 2, 2))
+    segments[:, 0, 0] = starts[index]
+    segments[:, 1, 0] = ends[index]
+    segments[:, :, 1] = index[:, None]
+
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(10, 5))  # Increased figure size for clarity
+    else:
+        fig = ax.figure
+    # Decreased line width and added transparency
+    ax.add_collection(LineCollection(segments, colors='k', linewidths=0.5, alpha=0.5, rasterized=True))
+    ax.autoscale_view()
+    ax.set_title(title)
+    ax.set_xlabel("Feature Lifetime")
+    ax.set_ylabel("Feature Index")
+    ax.grid(True)
+    ax.set_yticks([])  # Remove y-ticks for clarity
+    fig.tight_layout()  # Adjust layout to fit the figure size
+    return fig
+
 # Every connected component has a death value at ∞
 # In this case, we set it to 1 for better visualization
-def plot_component_barcode(births, title="Component Barcode"):
+def plot_component_barcode(births, title="Component Barcode", max_bars=None, ax=None, show=True):
     """
     Plots the component barcode representation of a network.
 
     Args:
         births (numpy.ndarray): Array of birth values.
         title (str, optional): Title of the plot. Defaults to "Component Barcode".
+        max_bars (int, optional): Draw at most this many bars, evenly spaced in lifetime order.
+        ax (matplotlib.axes.Axes, optional): Axes to draw on, a new figure by default.
+        show (bool): Show the figure.
+
+    Returns:
+        matplotlib.figure.Figure: The figure of the plot.
     """
-    plt.figure(figsize=(10, 5))  # Increased figure size for clarity
-    for i, birth in enumerate(births):
-        plt.plot([birth, 1], [i, i], 'k', lw=0.5, alpha=0.5)  # Decreased line width and added transparency
-    plt.title(title)
-    plt.xlabel("Feature Lifetime")
-    plt.ylabel("Feature Index")
-    plt.grid(True)
-    plt.yticks([])  # Remove y-ticks for clarity
-    plt.tight_layout()  # Adjust layout to fit the figure size
-    plt.show()
+    fig = _plot_bars(np.asarray(births), np.ones(len(births)), title, max_bars, ax)
+    if show:
+        figures.show(fig, title)
+    return fig
 
 # Cycles in the graph filtration are all considered born at −∞
 # In this case, we set it to 0 or -1 for better visualization
-def plot_cycle_barcode(deaths, title="Cycle Barcode"):
+def plot_cycle_barcode(deaths, title="Cycle Barcode", max_bars=None, ax=None, show=True):
     """
     Plots the cycle barcode representation of a network.
 
     Args:
         deaths (numpy.ndarray): Array of death values.
         title (str, optional): Title of the plot. Defaults to "Cycle Barcode".
+        max_bars (int, optional): Draw at most this many bars, evenly spaced in lifetime order.
+        ax (matplotlib.axes.Axes, optional): Axes to draw on, a new figure by default.
+        show (bool): Show the figure.
+
+    Returns:
+        matplotlib.figure.Figure: The figure of the plot.
+    """
+    if config.adj_mode == "ignore_negative" or config.adj_mode == "absolute":
+        birth = 0
+    elif config.adj_mode == "original":
+        birth = -1
+    fig = _plot_bars(birth, np.asarray(deaths), title, max_bars, ax)
+    if show:
+        figures.show(fig, title)
+    return fig
+
+def export_cohort_barcodes(subject_loader, out_dir, max_bars=20000, dpi=150, file_format="png"):
+    """
+    Writes the component and cycle barcode plots of every subject to files, in the
+    background in headless mode (see src/figures.py).
+
+    Args:
+        subject_loader (SubjectLoader): Subjects with their barcodes set (attached mode).
+        out_dir (str): Output directory.
+        max_bars (int, optional): Bars per plot, see plot_cycle_barcode.
+        dpi (int): Resolution of the images.
+        file_format (str): Image format, e.g. "png" or "pdf".
+
+    Returns:
+        list: Paths of the written files.
     """
-    plt.figure(figsize=(10, 5))  # Increased figure size for clarity
-    for i, death in enumerate(deaths):
-        if config.adj_mode == "ignore_negative" or config.adj_mode == "absolute":
-            birth = 0
-        elif config.adj_mode == "original":
-            birth = -1
-        plt.plot([birth, death], [i, i], 'k', lw=0.5, alpha=0.5)  # Decreased line width and added transparency
-    plt.title(title)
-    plt.xlabel("Feature Lifetime")
-    plt.ylabel("Feature Index")
-    plt.grid(True)
-    plt.yticks([])  # Remove y-ticks for clarity
-    plt.tight_layout()  # Adjust layout to fit the figure size
-    plt.show()
+    paths = []
+    for subject in subject_loader.subjects:
+        births, deaths = split_barcode(subject.barcode)
+        for kind, plot in (("component", plot_component_barcode), ("cycle", plot_cycle_barcode)):
+            fig = plot(births if kind == "component" else deaths,
+                       f"{kind.capitalize()} Barcode: {subject.subject_id}", max_bars=max_bars, show=False)
+            paths.append(figures.export(fig, f"{subject.subject_id}_{kind}_barcode.{file_format}",
+                                        directory=out_dir, dpi=dpi))
+            plt.close(fig)
+    return paths
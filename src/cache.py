@@ -0,0 +1,103 @@
+# cache.py
+# Bounded LRU memo of interpolated centroids
+# Seeds and restarts of a sweep often revisit the same partition of the subjects from the
+# same warm start, the memo turns those centroid updates into a dictionary lookup
+# Author: Boqian Shi
+
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+class CentroidCache:
+    """
+    Least recently used cache of centroid updates, shareable between the
+    k_centroids_clustering runs of one sweep.
+
+    Args:
+        maxsize (int): Maximum number of stored centroids, the least recently used one
+            is evicted first.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(member_ids, warm_start, member_weights=None, **settings):
+        """
+        Builds the key of a centroid update.
+
+        Args:
+            member_ids (iterable): Subject IDs of the cluster members, in any order.
+            warm_start (numpy.ndarray): Centroid the interpolation starts from.
+            member_weights (numpy.ndarray, optional): Sample weight of every member, in the
+                order of member_ids, since the cluster mean depends on them.
+            **settings: Everything else the update depends on (learning rate, weights,
+                iteration budget, optimizer and barcode settings...).
+
+        Returns:
+            tuple: Hashable key.
+        """
+        member_ids = list(member_ids)
+        order = sorted(range(len(member_ids)), key=lambda index: member_ids[index])
+        warm_start_hash = hashlib.blake2b(np.ascontiguousarray(warm_start).tobytes(), digest_size=16).hexdigest()
+        weights_hash = None
+        if member_weights is not None:
+            weights = np.ascontiguousarray(np.asarray(member_weights, dtype=np.float64)[order])
+            weights_hash = hashlib.blake2b(weights.tobytes(), digest_size=16).hexdigest()
+        return (tuple(member_ids[index] for index in order), warm_start_hash, weights_hash,
+                tuple(sorted(settings.items())))
+
+    def get(self, key):
+        """
+        Looks up a centroid.
+
+        Args:
+            key (tuple): Key from make_key.
+
+        Returns:
+            numpy.ndarray: A copy of the cached centroid, None on a miss.
+        """
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value.copy()
+
+    def put(self, key, value):
+        """
+        Stores a centroid, evicting the least recently used one when full.
+
+        Args:
+            key (tuple): Key from make_key.
+            value (numpy.ndarray): Centroid, a copy is stored.
+        """
+        self._entries[key] = value.copy()
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops every entry and resets the statistics."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups answered from the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        """One line summary of the cache statistics."""
+        return (f"Centroid cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate:.1%} hit rate), {len(self)}/{self.maxsize} entries")
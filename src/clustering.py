@@ -7,77 +7,240 @@ import matplotlib.pyplot as plt
 import numpy as np
 import config
 import src.barcode
+from src.accumulators import ClusterAccumulator
+from src.sketch import DistanceSketch
+import src.instrument as instrument
+import src.memory as memory
+import os
 import sys
 import math
 import random
+import time
 from src.subject import Subject, SubjectLoader
 from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import minimum_spanning_tree
 from matplotlib import pyplot as plt
 
+def topological_weight_array(top_relative_weight, n_features, geo_mode=None):
+    """
+    Feature weights of the top. distance for barcodes of the given width, 1 - w on the
+    geometric block of edge weights and w on the topological block of births and deaths.
+    Topology-only barcodes are all births and deaths, so every feature gets w.
+
+    Args:
+        top_relative_weight (float): Weight of the topological term, between 0 and 1.
+        n_features (int): Width of the barcodes.
+        geo_mode (str, optional): "geo_included" or "topo", config.geo_mode by default.
+
+    Returns:
+        numpy.ndarray: Weight of every feature.
+    """
+    if (geo_mode or config.geo_mode) == "topo":
+        return np.repeat(top_relative_weight, n_features)
+    n_edges = n_features // 2
+    return np.append(np.repeat(1 - top_relative_weight, n_edges),
+                     np.repeat(top_relative_weight, n_edges))
+
 class k_centroids_clustering:
+    """
+    Topological k-centroids clustering of brain networks.
+
+    Args:
+        subject_loader (SubjectLoader): Subjects with their barcodes set.
+        n_clusters (int): Number of clusters.
+        top_relative_weight (float): Weight of the topological term, between 0 and 1.
+        max_iter_alt (int): Maximum number of alternating iterations.
+        max_iter_interp (int): Maximum number of gradient steps per centroid update.
+        learning_rate (float): Step size of the topological interpolation.
+        interp_tol (float, optional): Stop the interpolation once the relative change of
+            its objective falls below this value.
+        grad_tol (float, optional): Stop the interpolation once the norm of its gradient
+            falls below this value.
+        adaptive_interp (bool): Scale the interpolation budget of every alternating
+            iteration by the fraction of subjects that kept their cluster, so early
+            iterations, where memberships still change a lot, use fewer steps.
+        min_iter_interp (int): Lower bound of the adaptive interpolation budget.
+        optimizer (str): Optimizer of the centroid update.
+            options: 1. "gd" - fixed-step gradient descent with learning_rate
+                     2. "nesterov" - Nesterov momentum with learning_rate and momentum
+                     3. "adam" - Adam adaptive steps with learning_rate and adam_betas
+                     4. "line_search" - backtracking line search on the combined objective,
+                        starting from learning_rate, so badly chosen rates cannot diverge
+        momentum (float): Momentum of the "nesterov" optimizer.
+        adam_betas (tuple): Decay rates of the first and second moments of "adam".
+        unchanged_policy (str): Update of the clusters whose members did not change since
+            their last update.
+            options: 1. "recompute" - run the full interpolation again
+                     2. "skip" - keep the previous centroid
+                     3. "resume" - continue the interpolation from the previous centroid
+                        for at most resume_iter_interp steps
+        resume_iter_interp (int): Interpolation budget of the "resume" policy.
+        centroid_cache (CentroidCache, optional): Memo of centroid updates keyed on the
+            cluster members, warm start and hyperparameters, usually shared by all runs
+            of a sweep.
+        init (str): Choice of the initial centroids among the subjects.
+            options: 1. "random" - uniform sample
+                     2. "kmeans++" - D^2 sampling under the weighted top. distance
+                     3. "greedy_kmeans++" - D^2 sampling of n_local_trials candidates
+                        per centroid, keeping the one that lowers the loss the most
+        n_local_trials (int, optional): Candidates per centroid of "greedy_kmeans++",
+            2 + log(n_clusters) by default.
+        sketch_components (int, optional): Assign subjects to centroids from sparse
+            random projections of this dimension, re-checking exactly only the subjects
+            near a boundary. The loss is then estimated from the sketches for the other
+            subjects. self.sketch.error(self.centroids) measures the sketch error.
+        sketch_margin (float, optional): Relative gap between the two closest centroids
+            under which a sketched assignment is re-checked, see DistanceSketch.
+        sample_weight (numpy.ndarray, optional): Weight of every subject in the cluster
+            means, the loss and the k-means++ draws, e.g. the weights of a coreset.
+    """
 
     def __init__(self, subject_loader, n_clusters, top_relative_weight, max_iter_alt,
-                 max_iter_interp, learning_rate):
+                 max_iter_interp, learning_rate, interp_tol=None, grad_tol=None,
+                 adaptive_interp=False, min_iter_interp=10, optimizer="gd", momentum=0.9,
+                 adam_betas=(0.9, 0.999), unchanged_policy="recompute", resume_iter_interp=10,
+                 centroid_cache=None, init="random", n_local_trials=None,
+                 sketch_components=None, sketch_margin=None,
+                 sample_weight=None):
         self.subject_loader = subject_loader
         self.n_clusters = n_clusters
         self.top_relative_weight = top_relative_weight
         self.max_iter_alt = max_iter_alt
         self.max_iter_interp = max_iter_interp
         self.learning_rate = learning_rate
+        self.interp_tol = interp_tol
+        self.grad_tol = grad_tol
+        self.adaptive_interp = adaptive_interp
+        self.min_iter_interp = min_iter_interp
+        if optimizer not in ("gd", "nesterov", "adam", "line_search"):
+            raise ValueError(f"Optimizer {optimizer} not supported in k_centroids_clustering")
+        self.optimizer = optimizer
+        self.momentum = momentum
+        self.adam_betas = adam_betas
+        if unchanged_policy not in ("recompute", "skip", "resume"):
+            raise ValueError(f"Unchanged cluster policy {unchanged_policy} not supported in k_centroids_clustering")
+        self.unchanged_policy = unchanged_policy
+        self.resume_iter_interp = resume_iter_interp
+        self.centroid_cache = centroid_cache
+        if init not in ("random", "kmeans++", "greedy_kmeans++"):
+            raise ValueError(f"Initialization {init} not supported in k_centroids_clustering")
+        self.init = init
+        self.n_local_trials = n_local_trials
+        self.n_iter = 0
+        self.sketch_components = sketch_components
+        self.sketch_margin = sketch_margin
+        self.sketch = None
+        self.sample_weight = None if sample_weight is None else np.asarray(sample_weight, dtype=float)
+        self.n_skipped = 0
+        self.loss_history = []
+        self.interp_steps = []
+        self.interp_seconds = []
+        self.interp_evaluations = []
 
     def fit_predict(self):
         """
         Computes topological clustering and predicts cluster index for each sample.
+        With config.geo_mode = "topo" the barcodes only hold the sorted births and deaths,
+        and the centroid of a cluster is the barycenter of its barcodes: sorted sets are
+        optimally matched rank by rank, so it is their mean, without any interpolation.
+        The loss of every alternating iteration is kept in self.loss_history, and the
+        number of steps, wall time and gradient evaluations of every centroid update in
+        self.interp_steps, self.interp_seconds and self.interp_evaluations. The number of
+        updates skipped or resumed under unchanged_policy is kept in self.n_skipped, and
+        the number of alternating iterations run in self.n_iter.
         """    
+        with instrument.timer("fit_predict"), memory.stage("fit_predict"):
+            return self._fit_predict()
+
+    def _fit_predict(self):
         random.seed(config.random_seed)    
-        # Since we are using HCI-MMP parcellation, the number of nodes is 360
-        # MST only returns 359 edges, we have to minus one if we are not using geometric info
-        if config.barcode_mode == "cycle":
-            n_node = 359 
-        elif config.barcode_mode == "attached":
-            n_node = 360
-        else:
-            print("Barcode Mode", config.barcode_mode," not supported in fit_predict function")
-        
-        n_edges = math.factorial(n_node) // math.factorial(2) // math.factorial(
-            n_node - 2)  # n_edges = (n_node choose 2)
-        n_births = n_node - 1
+        X = self.barcode_to_array()
+        if self.centroid_cache is not None:
+            subject_ids = np.array([subject.subject_id for subject in self.subject_loader.subjects])
+
+        topo_only = config.geo_mode == "topo"
         if config.geo_mode == "geo_included":
-            self.weight_array = np.append(
-                np.repeat(1 - self.top_relative_weight, n_edges),
-                np.repeat(self.top_relative_weight, n_edges))
-        #elif(config.geo_mode == "topo"):
-        #    self.weight_array = np.repeat(1 - self.top_relative_weight, n_edges)
+            # The geometric block holds the (n_node choose 2) edge weights and the topological
+            # block as many births and deaths, so the number of nodes follows from the width
+            # (360 for the HCP-MMP parcellation)
+            n_edges = X.shape[1] // 2
+            n_births = src.barcode.n_node_from_edges(n_edges) - 1
+            self.weight_array = topological_weight_array(self.top_relative_weight, X.shape[1])
+        elif topo_only:
+            # Sorted births and deaths only, of any width (component, cycle or attached)
+            self.weight_array = topological_weight_array(self.top_relative_weight, X.shape[1])
         else:
             print("Geo Mode", config.geo_mode," not supported in fit_predict function")
 
-        X = self.barcode_to_array()
-        
+        if self.sketch_components is not None:
+            self.sketch = DistanceSketch(self.sketch_components, self.sketch_margin,
+                                         random_state=config.random_seed).fit(X, self.weight_array)
+
         # Random initial condition
-        self.centroids = X[random.sample(range(X.shape[0]), self.n_clusters)]
+        if self.init == "random":
+            self.centroids = X[random.sample(range(X.shape[0]), self.n_clusters)]
+        else:
+            self.centroids = X[self._kmeans_plus_plus(X, greedy=self.init == "greedy_kmeans++")]
         #print(X.shape)
         #print(self.centroids.shape)
         # Assign the nearest centroid index to each data point
-        assigned_centroids = self._get_nearest_centroid(X[:, None, :], self.centroids[None, :, :])
-        prev_assigned_centroids = assigned_centroids
+        assigned_centroids, _ = self._assign(X)
+        # Cluster sums, updated from the subjects that change cluster only
+        accumulator = ClusterAccumulator(self.n_clusters, X.shape[1], X.dtype).fit(
+            X, assigned_centroids, self.sample_weight)
+        self.loss_history = []
+        self.interp_steps = []
+        self.interp_seconds = []
+        self.interp_evaluations = []
+        self.n_skipped = 0
+        # Every subject just got its first assignment
+        moved_fraction = 1.0
+        # Assignment used by the previous centroid update
+        updated_assignment = None
 
+        self.n_iter = 0
         for it in range(self.max_iter_alt):
+            instrument.count("alt_iterations")
+            self.n_iter += 1
+            if self.adaptive_interp:
+                max_iter_interp = max(self.min_iter_interp,
+                                      int(round(self.max_iter_interp * (1 - moved_fraction))))
+            else:
+                max_iter_interp = self.max_iter_interp
             for cluster in range(self.n_clusters):
-                # Previous iteration centroid
-                prev_centroid = np.zeros((n_node, n_node))
-                prev_centroid[np.triu_indices(
-                    prev_centroid.shape[0],
-                    k=1)] = self.centroids[cluster][:n_edges]
-                
-                # Determine data points belonging to each cluster
-                cluster_members = X[assigned_centroids == cluster]
+                in_cluster = assigned_centroids == cluster
+                cluster_iter_interp = max_iter_interp
+                if (self.unchanged_policy != "recompute" and updated_assignment is not None and
+                        np.array_equal(in_cluster, updated_assignment == cluster)):
+                    # Same members, so same sample mean and top. centroid as last time
+                    self.n_skipped += 1
+                    instrument.count("skipped_updates")
+                    if self.unchanged_policy == "skip":
+                        continue
+                    cluster_iter_interp = min(max_iter_interp, self.resume_iter_interp)
+
+                if topo_only:
+                    # Barycenter of the sorted sets
+                    self.centroids[cluster] = accumulator.mean(cluster)
+                    continue
 
+                # Previous iteration centroid, as its packed upper triangle
+                prev_centroid = self.centroids[cluster][:n_edges].copy()
+
+                if self.centroid_cache is not None:
+                    cache_key = self.centroid_cache.make_key(
+                        subject_ids[in_cluster], prev_centroid,
+                        member_weights=None if self.sample_weight is None else self.sample_weight[in_cluster],
+                        **self._cache_settings(cluster_iter_interp))
+                    cached_centroid = self.centroid_cache.get(cache_key)
+                    if cached_centroid is not None:
+                        instrument.count("centroid_cache_hits")
+                        self.centroids[cluster] = cached_centroid
+                        continue
+                
                 # Compute the sample mean and top. centroid of the cluster
-                cluster_mean = cluster_members.mean(axis=0)
-                sample_mean = np.zeros((n_node, n_node))
-                sample_mean[np.triu_indices(sample_mean.shape[0],
-                                            k=1)] = cluster_mean[:n_edges]
+                cluster_mean = accumulator.mean(cluster)
+                sample_mean = cluster_mean[:n_edges]
                 top_centroid = cluster_mean[n_edges:]
                 
                 top_centroid_birth_set = top_centroid[:n_births]
@@ -85,84 +248,306 @@ class k_centroids_clustering:
 
                 # Update the centroid
                 # try:
-                cluster_centroid = self._top_interpolation(
+                cluster_centroid, matching = self._top_interpolation(
                         prev_centroid, sample_mean, top_centroid_birth_set,
-                        top_centroid_death_set)
-                self.centroids[cluster] = src.barcode.get_barcode(cluster_centroid)
+                        top_centroid_death_set, cluster_iter_interp)
+                self.centroids[cluster] = self._centroid_barcode(cluster_centroid, matching)
+                if self.centroid_cache is not None:
+                    self.centroid_cache.put(cache_key, self.centroids[cluster])
                 #except:
                 #    print(
                 #        'Error: Possibly due to the learning rate is not within appropriate range.'
                 #    )
                 #    sys.exit(1)
 
-            # Update the cluster membership
-            assigned_centroids = self._get_nearest_centroid(
-                X[:, None, :], self.centroids[None, :, :])
+            updated_assignment = assigned_centroids
 
+            # Update the cluster membership
             # Compute and print loss as it is progressively decreasing
-            loss = self._compute_top_dist(
-                X, self.centroids[assigned_centroids]).sum() / len(X)
+            assigned_centroids, loss = self._assign(X)
             # print('Iteration: %d -> Loss: %f' % (it, loss))
+            self.loss_history.append(loss)
+            instrument.trace("loss", loss)
 
-            if (prev_assigned_centroids == assigned_centroids).all():
+            moved_fraction = len(accumulator.update(X, assigned_centroids)) / X.shape[0]
+            if moved_fraction == 0:
                 break
-            else:
-                prev_assigned_centroids = assigned_centroids
         return assigned_centroids
 
+    def predict(self, X=None):
+        """
+        Nearest centroid of every row of X, e.g. to extend a clustering fitted on a
+        coreset to the whole cohort.
+
+        Args:
+            X (numpy.ndarray, optional): Barcodes (n_samples, n_features), the subjects of
+                subject_loader by default.
+
+        Returns:
+            numpy.ndarray: Cluster index of every row.
+        """
+        if X is None:
+            X = self.barcode_to_array()
+        return self._get_nearest_centroid(X[:, None, :], self.centroids[None, :, :])
+
+    def _cache_settings(self, max_iter):
+        """
+        Everything besides the members, their weights and the warm start that a centroid
+        update depends on, including the barcode settings and the cohort the subject IDs
+        refer to.
+        """
+        return {'learning_rate': self.learning_rate, 'top_relative_weight': self.top_relative_weight,
+                'max_iter': max_iter, 'optimizer': self.optimizer, 'momentum': self.momentum,
+                'adam_betas': tuple(self.adam_betas), 'interp_tol': self.interp_tol,
+                'grad_tol': self.grad_tol, 'geo_mode': config.geo_mode,
+                'barcode_mode': config.barcode_mode, 'adj_mode': config.adj_mode,
+                'data_dir': os.path.abspath(config.data_dir)}
+
+    def _kmeans_plus_plus(self, X, greedy=False):
+        """
+        k-means++ seeding under the weighted top. distance.
+
+        Every centroid after the first is drawn among the subjects with a probability
+        proportional to their distance to the closest centroid already chosen. The greedy
+        variant draws several candidates and keeps the one giving the lowest total distance.
+        Draws come from the random module, seeded by config.random_seed in fit_predict.
+
+        Returns:
+            list: Indices of the subjects used as initial centroids.
+        """
+        n_rows = X.shape[0]
+        n_trials = 1
+        if greedy:
+            n_trials = self.n_local_trials or 2 + int(math.log(self.n_clusters))
+        indices = [random.randrange(n_rows)]
+        weights = np.ones(n_rows) if self.sample_weight is None else self.sample_weight
+        closest = self._compute_top_dist(X, X[indices[0]])
+        for _ in range(1, self.n_clusters):
+            if closest.sum() > 0:
+                candidates = random.choices(range(n_rows), weights=weights * closest, k=n_trials)
+            else:
+                # Every subject coincides with a centroid already, fall back to uniform draws
+                candidates = random.choices(range(n_rows), k=n_trials)
+            best = None
+            for candidate in candidates:
+                candidate_closest = np.minimum(closest, self._compute_top_dist(X, X[candidate]))
+                if best is None or np.dot(weights, candidate_closest) < np.dot(weights, best[1]):
+                    best = (candidate, candidate_closest)
+            indices.append(best[0])
+            closest = best[1]
+        return indices
+
     def barcode_to_array(self):
         """
         Convert barcode to array X.
         """
         
+        subjects = self.subject_loader.subjects
+        memory.require("barcode_to_array", len(subjects) * subjects[0].barcode.nbytes)
         X = []
-        for subject in self.subject_loader.subjects:
+        for subject in subjects:
             X.append(subject.barcode)
         X = np.asarray(X)
         return X
 
 
+    def _assign(self, X):
+        """Nearest centroid of every data point and the loss, from the sketches if enabled."""
+        if self.sketch is not None:
+            assigned_centroids, distances = self.sketch.assign(self.centroids)
+            return assigned_centroids, np.average(distances, weights=self.sample_weight)
+        assigned_centroids = self._get_nearest_centroid(X[:, None, :], self.centroids[None, :, :])
+        return assigned_centroids, self._compute_loss(X, assigned_centroids)
+
     def _get_nearest_centroid(self, X, centroids):
         """Determines cluster membership of data points."""
-        dist = self._compute_top_dist(X, centroids)
-        nearest_centroid_index = np.argmin(dist, axis=1)
+        with instrument.timer("nearest_centroid"):
+            # The broadcast difference and its square take 2 x n_clusters x n_features
+            # floats per data point, process as many points as the memory budget allows
+            n_rows = X.shape[0]
+            rows = memory.chunk_rows("nearest_centroid", 2 * centroids.shape[1] * X.shape[-1] * X.itemsize, n_rows)
+            nearest_centroid_index = np.empty(n_rows, dtype=np.intp)
+            for start in range(0, n_rows, rows):
+                dist = self._compute_top_dist(X[start:start + rows], centroids)
+                nearest_centroid_index[start:start + rows] = np.argmin(dist, axis=1)
         return nearest_centroid_index
 
+    def _compute_loss(self, X, assigned_centroids):
+        """Mean top. distance between networks and their assigned centroids."""
+        n_rows = X.shape[0]
+        rows = memory.chunk_rows("loss", 3 * X.shape[1] * X.itemsize, n_rows)
+        total = 0
+        for start in range(0, n_rows, rows):
+            dist = self._compute_top_dist(
+                X[start:start + rows], self.centroids[assigned_centroids[start:start + rows]])
+            if self.sample_weight is None:
+                total += dist.sum()
+            else:
+                total += np.dot(self.sample_weight[start:start + rows], dist)
+        if self.sample_weight is None:
+            return total / n_rows
+        return total / self.sample_weight.sum()
+
     def _compute_top_dist(self, X, centroid):
         """Computes the pairwise top. distances between networks and centroids."""
         return np.dot((X - centroid)**2, self.weight_array)
 
     def _top_interpolation(self, init_centroid, sample_mean,
-                           top_centroid_birth_set, top_centroid_death_set):
-        """Topological interpolation."""
+                           top_centroid_birth_set, top_centroid_death_set, max_iter=None):
+        """
+        Topological interpolation.
+
+        Minimizes the objective
+            (1 - w) * ||curr - sample_mean||^2 + w * ||curr - matched top. centroid||^2
+        with the optimizer selected by self.optimizer, for at most max_iter steps
+        (self.max_iter_interp by default), fewer when interp_tol or grad_tol is set and the
+        objective has converged. The number of steps, the wall time and the number of
+        gradient evaluations (one MST each) are appended to self.interp_steps,
+        self.interp_seconds and self.interp_evaluations.
+
+        The centroid is handled as its packed upper triangle (np.triu_indices order) and
+        updated in place, the gradients of the fixed-step optimizers reuse preallocated
+        buffers.
+
+        Returns:
+            tuple: The interpolated centroid and the birth-death matching of that centroid
+                when the last gradient evaluation was done on it, None otherwise.
+        """
+        if max_iter is None:
+            max_iter = self.max_iter_interp
+        w = self.top_relative_weight
+        line_search = self.optimizer == "line_search"
+        check_convergence = self.interp_tol is not None or self.grad_tol is not None or line_search
+        prev_objective = None
+        n_steps = 0
+        n_evaluations = 0
         curr = init_centroid
-        for _ in range(self.max_iter_interp):
-            # Geometric term gradient
-            geo_gradient = 2 * (curr - sample_mean)
-
-            # Topological term gradient
-            sorted_birth_ind, sorted_death_ind = self._compute_optimal_matching(
-                curr)
-            top_gradient = np.zeros_like(curr)
-            
-            top_gradient[sorted_birth_ind] = top_centroid_birth_set
-            top_gradient[sorted_death_ind] = top_centroid_death_set
-            top_gradient = 2 * (curr - top_gradient)
-
-            # Gradient update
-            curr -= self.learning_rate * (
-                (1 - self.top_relative_weight) * geo_gradient +
-                self.top_relative_weight * top_gradient)
-        return curr
-
-    def _compute_optimal_matching(self, adj):
-        mst, nonmst = src.barcode.bd_decomposition(adj)
-        birth_ind = np.nonzero(mst)
-        death_ind = np.nonzero(nonmst)
-        sorted_temp_ind = np.argsort(mst[birth_ind])
-        sorted_birth_ind = tuple(np.array(birth_ind)[:, sorted_temp_ind])
-        sorted_temp_ind = np.argsort(nonmst[death_ind])
-        sorted_death_ind = tuple(np.array(death_ind)[:, sorted_temp_ind])
-        return sorted_birth_ind, sorted_death_ind
-
-    
\ No newline at end of file
+        if self.optimizer == "nesterov":
+            velocity = np.zeros_like(curr)
+        elif self.optimizer == "adam":
+            first_moment = np.zeros_like(curr)
+            second_moment = np.zeros_like(curr)
+        step_size = self.learning_rate
+        # Gradients at curr already computed by the line search
+        gradients = None
+        # Matching of curr, valid until curr moves
+        matching = None
+        buffers = (np.empty_like(curr), np.empty_like(curr))
+        gradient = np.empty_like(curr)
+
+        start = time.perf_counter()
+        with instrument.timer("top_interpolation"):
+            for step in range(1, max_iter + 1):
+                if gradients is not None:
+                    geo_gradient, top_gradient = gradients
+                else:
+                    # Nesterov evaluates the gradient at the look-ahead point
+                    point = curr + self.momentum * velocity if self.optimizer == "nesterov" else curr
+                    geo_gradient, top_gradient, point_matching = self._interpolation_gradients(
+                        point, sample_mean, top_centroid_birth_set, top_centroid_death_set, out=buffers)
+                    matching = point_matching if point is curr else None
+                    n_evaluations += 1
+
+                if check_convergence:
+                    objective = self._interpolation_objective(geo_gradient, top_gradient)
+                # gradient = (1 - w) * geo_gradient + w * top_gradient, top_gradient is a
+                # scratch buffer from here on
+                np.multiply(geo_gradient, 1 - w, out=gradient)
+                gradient += np.multiply(top_gradient, w, out=top_gradient)
+
+                if check_convergence:
+                    if self.grad_tol is not None and np.linalg.norm(gradient) < self.grad_tol:
+                        break
+                    if (self.interp_tol is not None and prev_objective is not None and
+                            abs(prev_objective - objective) <= self.interp_tol * prev_objective):
+                        break
+                    prev_objective = objective
+
+                # Gradient update
+                matching = None
+                if self.optimizer == "nesterov":
+                    velocity = self.momentum * velocity - self.learning_rate * gradient
+                    curr += velocity
+                elif self.optimizer == "adam":
+                    beta1, beta2 = self.adam_betas
+                    first_moment = beta1 * first_moment + (1 - beta1) * gradient
+                    second_moment = beta2 * second_moment + (1 - beta2) * gradient**2
+                    curr -= self.learning_rate * (first_moment / (1 - beta1**step)) / (
+                        np.sqrt(second_moment / (1 - beta2**step)) + 1e-8)
+                elif line_search:
+                    # Backtracking (Armijo) from twice the last accepted step
+                    squared_norm = np.dot(gradient, gradient)
+                    step_size *= 2
+                    gradients = None
+                    for _ in range(30):
+                        trial = curr - step_size * gradient
+                        trial_geo, trial_top, trial_matching = self._interpolation_gradients(
+                            trial, sample_mean, top_centroid_birth_set, top_centroid_death_set)
+                        n_evaluations += 1
+                        if (self._interpolation_objective(trial_geo, trial_top) <=
+                                objective - 1e-4 * step_size * squared_norm):
+                            gradients = (trial_geo, trial_top)
+                            matching = trial_matching
+                            break
+                        step_size *= 0.5
+                    if gradients is None:
+                        # No step decreases the objective any more
+                        break
+                    curr = trial
+                else:
+                    curr -= np.multiply(gradient, self.learning_rate, out=gradient)
+                n_steps += 1
+        instrument.count("interpolation_steps", n_steps)
+        self.interp_steps.append(n_steps)
+        self.interp_seconds.append(time.perf_counter() - start)
+        self.interp_evaluations.append(n_evaluations)
+        return curr, matching
+
+    def _interpolation_gradients(self, curr, sample_mean, top_centroid_birth_set,
+                                 top_centroid_death_set, out=None):
+        """
+        Gradients of the geometric and topological terms of the interpolation at curr.
+
+        Args:
+            curr (numpy.ndarray): Packed centroid, its zeros are replaced by the smallest
+                positive float as in bd_decomposition.
+            out (tuple, optional): Two buffers receiving the geometric and topological
+                gradients, new arrays are allocated without them.
+
+        Returns:
+            tuple: Geometric gradient, topological gradient and the matching of curr.
+        """
+        if out is None:
+            out = (np.empty_like(curr), np.empty_like(curr))
+        geo_gradient, top_gradient = out
+        # Geometric term gradient
+        np.multiply(np.subtract(curr, sample_mean, out=geo_gradient), 2, out=geo_gradient)
+
+        # Topological term gradient, against the top. centroid matched to the sorted sets
+        curr[curr == 0] = np.nextafter(0, 1)
+        matching = self._compute_optimal_matching(curr)
+        sorted_birth_ind, sorted_death_ind = matching
+        top_gradient[sorted_birth_ind] = top_centroid_birth_set
+        top_gradient[sorted_death_ind] = top_centroid_death_set
+        np.multiply(np.subtract(curr, top_gradient, out=top_gradient), 2, out=top_gradient)
+        return geo_gradient, top_gradient, matching
+
+    def _interpolation_objective(self, geo_gradient, top_gradient):
+        """Interpolation objective, both gradients being 2 * residual."""
+        return ((1 - self.top_relative_weight) * np.dot(geo_gradient, geo_gradient) +
+                self.top_relative_weight * np.dot(top_gradient, top_gradient)) / 4
+
+    def _centroid_barcode(self, centroid, matching=None):
+        """
+        Barcode of an interpolated centroid, reusing the matching of its last gradient
+        evaluation when the "ignore_negative" clipping leaves the edges unchanged.
+        """
+        if matching is not None and (centroid < 0).any():
+            matching = None
+        return src.barcode.packed_barcode(centroid, matching)
+
+    def _compute_optimal_matching(self, vec):
+        """Packed indices of the births and deaths of a packed network, sorted by weight."""
+        instrument.count("mst_calls")
+        with instrument.timer("optimal_matching"):
+            return src.barcode.packed_bd_decomposition(vec)
@@ -0,0 +1,89 @@
+# coreset.py
+# Coresets of subjects for the weighted topological k-centroids cost
+# A coreset is a small weighted subset of the subjects whose clustering cost approximates
+# the cost of the full cohort for every choice of centroids, so hyperparameter sweeps can
+# run on it and only the winning configuration is refit on all subjects
+# Author: Boqian Shi
+
+import math
+import numpy as np
+
+
+def _weighted_dist(X, centroid, weight_array):
+    return np.dot((X - centroid)**2, weight_array)
+
+
+def build_coreset(X, weight_array, n_clusters, coreset_size, random_state=0):
+    """
+    Sensitivity sampling coreset under the weighted top. distance
+    (Bachem, Lucic and Krause, "Practical Coreset Constructions for Machine Learning").
+
+    A rough solution B of n_clusters centres is drawn by D^2 sampling. The sensitivity
+    of every subject is bounded by
+        alpha * d(x, B) / c + 2 * alpha * (cost of its cluster in B) / (|cluster| * c) + 4 * n / |cluster|
+    with c the mean distance to B and alpha = 16 * (log k + 2). Subjects are drawn with
+    probabilities proportional to those bounds and weighted by the inverse of their
+    expected number of draws; duplicates are merged into a single weighted subject.
+
+    Args:
+        X (numpy.ndarray): Barcodes (n_samples, n_features).
+        weight_array (numpy.ndarray): Feature weights of the top. distance.
+        n_clusters (int): Number of clusters.
+        coreset_size (int): Number of draws, the coreset has at most this many subjects.
+        random_state (int): Seed of the sampling.
+
+    Returns:
+        tuple: Indices of the coreset subjects and their weights, which sum to about n_samples.
+    """
+    rng = np.random.default_rng(random_state)
+    n_rows = X.shape[0]
+    if coreset_size >= n_rows:
+        return np.arange(n_rows), np.ones(n_rows)
+
+    # Rough solution by D^2 sampling
+    centres = [rng.integers(n_rows)]
+    closest = _weighted_dist(X, X[centres[0]], weight_array)
+    assigned = np.zeros(n_rows, dtype=np.intp)
+    for index in range(1, n_clusters):
+        total = closest.sum()
+        centre = rng.choice(n_rows, p=closest / total) if total > 0 else rng.integers(n_rows)
+        centres.append(centre)
+        dist = _weighted_dist(X, X[centre], weight_array)
+        assigned[dist < closest] = index
+        closest = np.minimum(closest, dist)
+
+    # Sensitivity bounds
+    alpha = 16 * (math.log(n_clusters) + 2)
+    mean_cost = max(closest.mean(), np.finfo(float).tiny)
+    cluster_sizes = np.bincount(assigned, minlength=n_clusters)
+    cluster_costs = np.bincount(assigned, weights=closest, minlength=n_clusters)
+    sensitivity = (alpha * closest / mean_cost +
+                   2 * alpha * cluster_costs[assigned] / (cluster_sizes[assigned] * mean_cost) +
+                   4 * n_rows / cluster_sizes[assigned])
+    probabilities = sensitivity / sensitivity.sum()
+
+    draws = rng.choice(n_rows, size=coreset_size, p=probabilities)
+    indices, n_draws = np.unique(draws, return_counts=True)
+    weights = n_draws / (coreset_size * probabilities[indices])
+    return indices, weights
+
+
+def coreset_cost_error(X, weight_array, indices, weights, centroids):
+    """
+    Relative error of the coreset cost for given centroids, to check a coreset.
+
+    Args:
+        X (numpy.ndarray): Barcodes of the full cohort.
+        weight_array (numpy.ndarray): Feature weights of the top. distance.
+        indices (numpy.ndarray): Coreset subjects.
+        weights (numpy.ndarray): Coreset weights.
+        centroids (numpy.ndarray): Centroids (n_clusters, n_features).
+
+    Returns:
+        float: |coreset cost - full cost| / full cost.
+    """
+    def cost(rows, row_weights):
+        dist = np.stack([_weighted_dist(rows, centroid, weight_array) for centroid in centroids], axis=1)
+        return np.dot(row_weights, dist.min(axis=1))
+    full_cost = cost(X, np.ones(X.shape[0]))
+    return abs(cost(X[indices], weights) - full_cost) / full_cost
@@ -0,0 +1,281 @@
+# distance.py
+# All-pairs topological distances between subjects
+# The squared distance splits into a geometric (edge weights), a birth and a death block,
+# kept separate so any top_relative_weight or lambda mix is a linear combination of three
+# N x N matrices. Blocks are computed with the Gram-matrix trick on a thread pool and
+# cached on disk, keyed by the cohort and the barcode settings
+# Author: Boqian Shi
+
+import hashlib
+import os
+import numpy as np
+import config
+import src.instrument as instrument
+import src.memory as memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from sklearn.manifold import MDS, TSNE
+from src.barcode import n_node_from_edges
+
+
+def squared_distances(A, block_rows=128, n_jobs=None):
+    """
+    Pairwise squared Euclidean distances between the rows of A.
+
+    Uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, one block of rows at a time so the
+    temporary products stay small; blocks run on a thread pool, numpy releases the GIL
+    inside the matrix products.
+
+    Args:
+        A (numpy.ndarray): Rows (n_samples, n_features).
+        block_rows (int): Rows per block.
+        n_jobs (int, optional): Number of threads, defaults to the number of CPUs.
+
+    Returns:
+        numpy.ndarray: Symmetric matrix (n_samples, n_samples) with a zero diagonal.
+    """
+    n_rows = A.shape[0]
+    norms = np.einsum('ij,ij->i', A, A)
+    result = np.empty((n_rows, n_rows), dtype=A.dtype)
+
+    def block(start):
+        stop = min(start + block_rows, n_rows)
+        gram = A[start:stop] @ A.T
+        np.maximum(norms[start:stop, None] + norms[None, :] - 2 * gram, 0, out=result[start:stop])
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as executor:
+        list(executor.map(block, range(0, n_rows, block_rows)))
+    # Cancellation leaves round-off on the diagonal and asymmetric round-off elsewhere
+    result = (result + result.T) / 2
+    np.fill_diagonal(result, 0)
+    return result
+
+
+class TopologicalDistances:
+    """
+    Geometric, birth and death blocks of the squared topological distances of a cohort.
+
+    Args:
+        geo (numpy.ndarray): Squared distances between the edge weights, zeros in topology-only mode.
+        birth (numpy.ndarray): Squared distances between the sorted birth sets.
+        death (numpy.ndarray): Squared distances between the sorted death sets.
+        subject_ids (list): Subject ID of every row.
+    """
+
+    def __init__(self, geo, birth, death, subject_ids):
+        self.geo = geo
+        self.birth = birth
+        self.death = death
+        self.subject_ids = list(subject_ids)
+
+    def combine(self, top_relative_weight=None, l=None, squared=True):
+        """
+        Distance matrix for a mix of the blocks.
+
+        With top_relative_weight w it is the distance of k_centroids_clustering,
+        (1 - w) * geo + w * (birth + death). With lambda l it is the distance between the
+        barcodes get_barcode returns for that l, (1 - l)^2 * geo + l^2 * (birth + death),
+        except for l = 1, where get_barcode keeps the edge weights unscaled and the
+        distance is the unweighted sum. Without either, the unweighted sum.
+
+        Args:
+            top_relative_weight (float, optional): Weight of the topological blocks.
+            l (float, optional): Lambda of get_barcode.
+            squared (bool): Return squared distances, plain distances otherwise (for MDS
+                or t-SNE).
+
+        Returns:
+            numpy.ndarray: Distance matrix (n_samples, n_samples).
+        """
+        if top_relative_weight is not None:
+            geo_weight, top_weight = 1 - top_relative_weight, top_relative_weight
+        elif l is not None and l != 1:
+            geo_weight, top_weight = (1 - l)**2, l**2
+        else:
+            geo_weight, top_weight = 1, 1
+        distances = geo_weight * self.geo + top_weight * (self.birth + self.death)
+        return distances if squared else np.sqrt(distances)
+
+    def save(self, file_path):
+        """Writes the blocks to a .npz file."""
+        np.savez(file_path, geo=self.geo, birth=self.birth, death=self.death,
+                 subject_ids=np.array(self.subject_ids))
+
+    @classmethod
+    def load(cls, file_path):
+        """Reads blocks written by save."""
+        with np.load(file_path) as blocks:
+            return cls(blocks['geo'], blocks['birth'], blocks['death'], blocks['subject_ids'].tolist())
+
+
+def _cache_key(subject_ids, X):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("\n".join(subject_ids).encode())
+    digest.update(f"{config.barcode_mode}|{config.adj_mode}|{config.geo_mode}|{X.shape}".encode())
+    digest.update(np.ascontiguousarray(X).tobytes())
+    return digest.hexdigest()
+
+
+def compute_topological_distances(subject_loader, cache_dir=None, block_rows=128, n_jobs=None):
+    """
+    All-pairs distance blocks of the subjects, from their barcodes.
+
+    The barcodes must be computed with l = 1 (the default of get_barcode), either with
+    the geometric block (config.geo_mode = "geo_included") or without it ("topo").
+    Results are cached in cache_dir under a key made of the subject IDs, the barcode
+    settings of config.py and the barcodes themselves.
+
+    Args:
+        subject_loader (SubjectLoader): Subjects with their barcodes set.
+        cache_dir (str, optional): Cache directory, config.distance_cache_dir by default,
+            no caching when both are None.
+        block_rows (int): Rows per block of the Gram products.
+        n_jobs (int, optional): Number of threads.
+
+    Returns:
+        TopologicalDistances: The three blocks.
+    """
+    subjects = subject_loader.subjects
+    subject_ids = [subject.subject_id for subject in subjects]
+    X = np.asarray([subject.barcode for subject in subjects])
+
+    if cache_dir is None:
+        cache_dir = getattr(config, 'distance_cache_dir', None)
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"topological_distances_{_cache_key(subject_ids, X)}.npz")
+        if os.path.exists(cache_file):
+            instrument.count("distance_cache_hits")
+            return TopologicalDistances.load(cache_file)
+
+    # Three N x N blocks plus the Gram products of one block
+    memory.require("topological_distances", 4 * len(subjects)**2 * X.itemsize)
+    with instrument.timer("topological_distances"):
+        if config.geo_mode == "topo":
+            n_births = n_node_from_edges(X.shape[1]) - 1
+            geo = np.zeros((len(subjects), len(subjects)), dtype=X.dtype)
+            top = X
+        else:
+            n_edges = X.shape[1] // 2
+            n_births = n_node_from_edges(n_edges) - 1
+            geo = squared_distances(X[:, :n_edges], block_rows, n_jobs)
+            top = X[:, n_edges:]
+        birth = squared_distances(top[:, :n_births], block_rows, n_jobs)
+        death = squared_distances(top[:, n_births:], block_rows, n_jobs)
+    distances = TopologicalDistances(geo, birth, death, subject_ids)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        distances.save(cache_file)
+    return distances
+
+
+def classical_mds(distances, n_components=2):
+    """
+    Classical (Torgerson) MDS of a distance matrix, e.g. as the initial embedding of t-SNE.
+
+    Args:
+        distances (numpy.ndarray): Distance matrix (not squared).
+        n_components (int): Dimension of the embedding.
+
+    Returns:
+        numpy.ndarray: Embedding (n_samples, n_components).
+    """
+    n_rows = distances.shape[0]
+    centering = np.eye(n_rows) - np.ones((n_rows, n_rows)) / n_rows
+    gram = -0.5 * centering @ (distances**2) @ centering
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    return eigenvectors[:, order] * np.sqrt(np.maximum(eigenvalues[order], 0))
+
+
+def mds_embedding(distances, n_components=2, random_state=0):
+    """
+    Metric MDS embedding of a precomputed distance matrix.
+
+    Args:
+        distances (numpy.ndarray): Distance matrix (not squared).
+        n_components (int): Dimension of the embedding.
+        random_state (int): Seed of the SMACOF initialization.
+
+    Returns:
+        numpy.ndarray: Embedding (n_samples, n_components).
+    """
+    return MDS(n_components=n_components, dissimilarity='precomputed',
+               random_state=random_state).fit_transform(distances)
+
+
+def tsne_embedding(distances, n_components=2, init='random', random_state=42, **kwargs):
+    """
+    t-SNE embedding of a precomputed distance matrix.
+
+    sklearn squares Euclidean distances before computing the affinities but uses
+    precomputed ones as given, so squared distances reproduce t-SNE on the raw rows.
+
+    Args:
+        distances (numpy.ndarray): Distance matrix, squared to match TSNE on the rows.
+        n_components (int): Dimension of the embedding.
+        init (str or numpy.ndarray): "random" or an initial embedding, e.g. from
+            classical_mds or the embedding of a neighbouring setting.
+        random_state (int): Seed of t-SNE.
+        **kwargs: Other arguments of sklearn.manifold.TSNE.
+
+    Returns:
+        numpy.ndarray: Embedding (n_samples, n_components).
+    """
+    return TSNE(n_components=n_components, metric='precomputed', init=init,
+                random_state=random_state, **kwargs).fit_transform(distances)
+
+
+def _tsne_init(embedding):
+    # Same scale as the "pca" initialization of sklearn, the first component has standard deviation 1e-4
+    return embedding / np.std(embedding[:, 0]) * 1e-4
+
+
+def _tsne_chain(distances, l_values, random_state, kwargs):
+    embeddings = []
+    init = _tsne_init(classical_mds(distances.combine(l=l_values[0], squared=False)))
+    for l in l_values:
+        embedding = tsne_embedding(distances.combine(l=l), init=init, random_state=random_state, **kwargs)
+        embeddings.append(embedding)
+        init = _tsne_init(embedding)
+    return embeddings
+
+
+def tsne_lambda_sweep(distances, l_values, n_chunks=None, n_jobs=None, random_state=42, **kwargs):
+    """
+    t-SNE embeddings of the get_barcode barcodes for a range of lambdas.
+
+    Every lambda only recombines the distance blocks, no barcode is recomputed. The
+    lambdas are split in chunks of neighbouring values: the first embedding of a chunk is
+    initialized by classical MDS (the precomputed-distance equivalent of the "pca"
+    initialization), the next ones by the embedding of the previous lambda, rescaled to
+    the same initial spread. Chunks run on a process pool.
+
+    Args:
+        distances (TopologicalDistances): Distance blocks of the cohort.
+        l_values (list): Lambdas, in sweep order.
+        n_chunks (int, optional): Number of warm-started chains, defaults to n_jobs.
+        n_jobs (int, optional): Number of worker processes, defaults to the number of
+            CPUs. 1 runs in-process.
+        random_state (int): Seed of t-SNE.
+        **kwargs: Other arguments of sklearn.manifold.TSNE.
+
+    Returns:
+        list: Embedding (n_samples, 2) of every lambda, in the order of l_values.
+    """
+    l_values = list(l_values)
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    if n_chunks is None:
+        n_chunks = n_jobs
+    n_chunks = max(1, min(n_chunks, len(l_values)))
+    chunks = [list(chunk) for chunk in np.array_split(l_values, n_chunks)]
+
+    with instrument.timer("tsne_lambda_sweep"):
+        if n_jobs == 1:
+            results = [_tsne_chain(distances, chunk, random_state, kwargs) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(_tsne_chain, [distances] * len(chunks), chunks,
+                                            [random_state] * len(chunks), [kwargs] * len(chunks)))
+    return [embedding for chain in results for embedding in chain]
@@ -0,0 +1,118 @@
+# feature_store.py
+# Memory-mapped store of subject barcodes
+# Barcodes are written one subject at a time to a single .npy file and read back through a
+# memory map, so cohorts larger than the RAM can be clustered batch by batch
+# Author: Boqian Shi
+
+import json
+import os
+import numpy as np
+import config
+import src.instrument as instrument
+from numpy.lib.format import open_memmap
+from src.barcode import get_barcode
+
+
+class FeatureStore:
+    """
+    Read-only view of a feature store written by FeatureStore.create.
+
+    Args:
+        path (str): Path of the .npy feature file, the subject IDs and groups are read
+            from the sidecar file next to it (path + ".json").
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.features = np.load(path, mmap_mode='r')
+        with open(path + '.json', 'r') as file:
+            sidecar = json.load(file)
+        self.subject_ids = sidecar['subject_ids']
+        self.groups = sidecar['groups']
+
+    @classmethod
+    def create(cls, path, subject_loader, barcode_mode="attached", adj_mode="ignore_negative",
+               dtype=np.float64):
+        """
+        Writes the barcodes of a cohort to a feature store.
+
+        Subjects that already have a barcode are written as is. For the others the
+        network is taken from subject.data or, when the data is not loaded, read from
+        config.data_dir just for the time of its barcode, so only one network is in
+        memory at any time.
+
+        Args:
+            path (str): Path of the .npy feature file.
+            subject_loader (SubjectLoader): Cohort to store.
+            barcode_mode (str): Barcode mode, see get_barcode.
+            adj_mode (str): Adjacency matrix mode, see get_barcode.
+            dtype (numpy.dtype): Data type of the stored features.
+
+        Returns:
+            FeatureStore: The store opened for reading.
+        """
+        subjects = subject_loader.subjects
+        features = None
+        for index, subject in enumerate(subjects):
+            barcode = subject.barcode
+            if barcode is None:
+                data = subject.data
+                if data is None:
+                    data = np.load(os.path.join(config.data_dir, f"sub-{subject.subject_id}.npy"))
+                    instrument.count("bytes_loaded", data.nbytes)
+                barcode = get_barcode(data.copy(), barcode_mode=barcode_mode, adj_mode=adj_mode)
+            if features is None:
+                features = open_memmap(path, mode='w+', dtype=dtype, shape=(len(subjects), len(barcode)))
+            features[index] = barcode
+        if features is not None:
+            features.flush()
+            del features
+        with open(path + '.json', 'w') as file:
+            json.dump({'subject_ids': [subject.subject_id for subject in subjects],
+                       'groups': [subject.group for subject in subjects]}, file)
+        return cls(path)
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    @property
+    def n_features(self):
+        """Width of the stored rows."""
+        return self.features.shape[1]
+
+    def rows(self, indices):
+        """
+        Reads some rows into memory.
+
+        Args:
+            indices (sequence): Row indices, read in increasing order to keep the disk
+                access sequential and returned in the given order.
+
+        Returns:
+            numpy.ndarray: The rows (len(indices), n_features).
+        """
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        rows = np.empty((len(indices), self.n_features), dtype=self.features.dtype)
+        rows[order] = self.features[indices[order]]
+        instrument.count("bytes_loaded", rows.nbytes)
+        return rows
+
+    def iter_chunks(self, chunk_rows):
+        """
+        Iterates over the store in blocks of consecutive rows.
+
+        Args:
+            chunk_rows (int): Rows per block.
+
+        Yields:
+            tuple: Index of the first row of the block and the block read into memory.
+        """
+        for start in range(0, len(self), chunk_rows):
+            rows = np.array(self.features[start:start + chunk_rows])
+            instrument.count("bytes_loaded", rows.nbytes)
+            yield start, rows
+
+    def get_labels(self):
+        """Groups of the stored subjects, as SubjectLoader.get_labels."""
+        return list(self.groups)
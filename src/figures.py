@@ -0,0 +1,118 @@
+# figures.py
+# Figure output for interactive and unattended runs
+# With config.headless, figures are pickled to a background process pool that renders them
+# with the Agg backend into config.results_dir, so a sweep never blocks on a window or on
+# rasterizing a figure; otherwise figures are shown as before
+# Author: Boqian Shi
+
+import os
+import re
+import atexit
+import pickle
+import matplotlib
+import config
+from concurrent.futures import ProcessPoolExecutor
+
+if config.headless:
+    matplotlib.use('Agg')
+
+from matplotlib import pyplot as plt
+
+_executor = None
+_futures = []
+_n_figures = 0
+
+
+def _render(pickled_fig, path, savefig_kwargs):
+    # Runs in a worker process, the unpickled figure is drawn by the Agg backend
+    fig = pickle.loads(pickled_fig)
+    fig.savefig(path, **savefig_kwargs)
+    plt.close(fig)
+    return path
+
+
+def _file_path(filename, directory):
+    global _n_figures
+    _n_figures += 1
+    if filename is None:
+        filename = f"figure_{os.getpid()}_{_n_figures}.png"
+    filename = re.sub(r'[^\w.\-]+', '_', filename)
+    if not os.path.splitext(filename)[1]:
+        filename += '.png'
+    directory = config.results_dir if directory is None else directory
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def export(fig, filename=None, directory=None, **savefig_kwargs):
+    """
+    Writes a figure to config.results_dir.
+
+    In headless mode the figure is pickled and rendered by a worker process, so this call
+    returns once the pickle is queued and the figure can be closed or reused; call wait()
+    before reading the file. Otherwise it is written right away.
+
+    Args:
+        fig (matplotlib.figure.Figure): Figure to write.
+        filename (str, optional): File name, a numbered PNG by default. Characters that
+            do not belong in a file name are replaced, ".png" is added without an extension.
+        directory (str, optional): Output directory, config.results_dir by default.
+        **savefig_kwargs: Arguments of Figure.savefig (dpi, bbox_inches...).
+
+    Returns:
+        str: Path of the file.
+    """
+    global _executor
+    path = _file_path(filename, directory)
+    if not config.headless:
+        fig.savefig(path, **savefig_kwargs)
+        return path
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=config.figure_workers)
+    _futures.append(_executor.submit(_render, pickle.dumps(fig), path, savefig_kwargs))
+    return path
+
+
+def show(fig=None, filename=None, **savefig_kwargs):
+    """
+    Replacement of plt.show() for code that also runs unattended.
+
+    Interactive runs show the figure. Headless runs export it under filename (or a
+    numbered name) and close it instead of blocking.
+
+    Args:
+        fig (matplotlib.figure.Figure, optional): Figure, the current one by default.
+        filename (str, optional): File name in headless mode.
+        **savefig_kwargs: Arguments of Figure.savefig in headless mode.
+
+    Returns:
+        str: Path of the exported file in headless mode, None otherwise.
+    """
+    if not config.headless:
+        plt.show()
+        return None
+    if fig is None:
+        fig = plt.gcf()
+    path = export(fig, filename, **savefig_kwargs)
+    plt.close(fig)
+    return path
+
+
+def wait():
+    """
+    Waits for the queued figures and stops the worker processes.
+
+    Returns:
+        list: Paths of the figures written since the last call.
+    """
+    global _executor
+    paths = [future.result() for future in _futures]
+    _futures.clear()
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+    return paths
+
+
+# Scripts that never call wait() still get their figures
+atexit.register(wait)
@@ -0,0 +1,197 @@
+# instrument.py
+# Opt-in timers, counters and traces for the pipeline stages
+# Disabled by default; every call is a single flag check until enable() is called
+# or config.instrument is set
+# Author: Boqian Shi
+
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import config
+
+enabled = bool(getattr(config, 'instrument', 0))
+
+# Chrome trace events are capped so long sweeps cannot exhaust memory
+MAX_EVENTS = 1000000
+
+_timings = {}   # name -> [calls, total seconds]
+_counters = {}  # name -> value
+_traces = {}    # name -> list of recorded values
+_events = []    # Chrome trace events
+_origin = time.perf_counter()
+
+
+class _NullTimer:
+    """Timer returned while instrumentation is disabled, does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        timing = _timings.get(self.name)
+        if timing is None:
+            _timings[self.name] = [1, end - self.start]
+        else:
+            timing[0] += 1
+            timing[1] += end - self.start
+        if len(_events) < MAX_EVENTS:
+            _events.append({'name': self.name, 'ph': 'X', 'ts': (self.start - _origin) * 1e6,
+                            'dur': (end - self.start) * 1e6, 'pid': os.getpid(),
+                            'tid': threading.get_ident()})
+        return False
+
+
+def enable(flag=True):
+    """
+    Turns the instrumentation on or off.
+
+    Args:
+        flag (bool): True to record timers, counters and traces.
+    """
+    global enabled
+    enabled = flag
+
+
+def reset():
+    """Clears everything recorded so far."""
+    global _origin
+    _timings.clear()
+    _counters.clear()
+    _traces.clear()
+    _events.clear()
+    _origin = time.perf_counter()
+
+
+def timer(name):
+    """
+    Context manager timing a stage.
+
+    Args:
+        name (str): Name of the stage, e.g. "optimal_matching".
+
+    Returns:
+        A context manager, shared and free of work when instrumentation is disabled.
+    """
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def count(name, n=1):
+    """
+    Increments a counter.
+
+    Args:
+        name (str): Name of the counter, e.g. "mst_calls".
+        n (int): Increment.
+    """
+    if enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def trace(name, value):
+    """
+    Records a value of a trace, e.g. the loss of every alternating iteration.
+
+    Args:
+        name (str): Name of the trace.
+        value (float): Recorded value.
+    """
+    if enabled:
+        _traces.setdefault(name, []).append(value)
+        if len(_events) < MAX_EVENTS:
+            _events.append({'name': name, 'ph': 'C', 'ts': (time.perf_counter() - _origin) * 1e6,
+                            'pid': os.getpid(), 'args': {name: value}})
+
+
+def summary():
+    """
+    Collects everything recorded so far.
+
+    Returns:
+        dict: Timings (calls, total and mean seconds), counters and traces.
+    """
+    return {
+        'timings': {name: {'calls': calls, 'total_s': total, 'mean_s': total / calls}
+                    for name, (calls, total) in _timings.items()},
+        'counters': dict(_counters),
+        'traces': {name: list(values) for name, values in _traces.items()}
+    }
+
+
+def report():
+    """Prints the timings and counters, slowest stage first."""
+    print(f"{'Stage':<28}{'Calls':>10}{'Total (s)':>14}{'Mean (ms)':>14}")
+    for name, (calls, total) in sorted(_timings.items(), key=lambda item: -item[1][1]):
+        print(f"{name:<28}{calls:>10}{total:>14.3f}{total / calls * 1e3:>14.3f}")
+    for name, value in sorted(_counters.items()):
+        print(f"{name:<28}{value:>10}")
+
+
+def export_json(file_path):
+    """
+    Writes the summary to a JSON file.
+
+    Args:
+        file_path (str): Output file.
+    """
+    with open(file_path, 'w') as file:
+        json.dump(summary(), file, indent=2)
+
+
+def export_chrome_trace(file_path):
+    """
+    Writes the recorded stages and traces in the Chrome trace event format.
+    Open the file in chrome://tracing or https://ui.perfetto.dev.
+
+    Args:
+        file_path (str): Output file.
+    """
+    with open(file_path, 'w') as file:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms',
+                   'otherData': {'counters': _counters}}, file)
+
+
+def profile(func, *args, output_file=None, sort='cumulative', n_lines=30, **kwargs):
+    """
+    Runs a function under cProfile and prints its hottest calls.
+
+    Args:
+        func (callable): Entry point to profile, e.g. main.k_centroids_test.
+        *args: Positional arguments of func.
+        output_file (str, optional): File receiving the raw stats, readable by pstats or snakeviz.
+        sort (str): pstats sort key.
+        n_lines (int): Number of printed lines.
+        **kwargs: Keyword arguments of func.
+
+    Returns:
+        The return value of func.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        if output_file is not None:
+            profiler.dump_stats(output_file)
+        pstats.Stats(profiler).sort_stats(sort).print_stats(n_lines)
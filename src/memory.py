@@ -0,0 +1,189 @@
+# memory.py
+# Peak-memory accounting per pipeline stage and memory budget enforcement
+# The budget comes from config.memory_budget (bytes, None for no limit); the chunked code
+# paths ask chunk_rows() how much they may allocate, the others call require() before a
+# large allocation, so a run that cannot fit fails early with a report instead of being
+# killed by the OOM killer
+# Author: Boqian Shi
+
+import os
+import sys
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, resident memory is then unknown
+    resource = None
+import tracemalloc
+from contextlib import contextmanager
+import config
+
+budget = getattr(config, 'memory_budget', None)
+tracking = bool(getattr(config, 'memory_tracking', 0))
+
+_stages = {}  # name -> dict of the last recorded measures
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """Raised before an allocation that would not fit in the memory budget."""
+
+
+def set_budget(nbytes):
+    """
+    Sets the memory budget of the run.
+
+    Args:
+        nbytes (int): Maximum resident memory in bytes, None to disable the budget.
+    """
+    global budget
+    budget = nbytes
+
+
+def enable_tracking(flag=True):
+    """
+    Turns the per-stage tracemalloc accounting on or off.
+
+    Args:
+        flag (bool): True to record traced peaks and snapshots per stage.
+    """
+    global tracking
+    tracking = flag
+
+
+def current_rss():
+    """Resident memory of the process in bytes, None when the platform does not report it."""
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident memory of the process in bytes, None without the resource module."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def available():
+    """
+    Bytes left in the budget, None without a budget. When the resident memory is unknown,
+    the memory traced by tracemalloc stands in for it (nothing if tracing is off).
+    """
+    if budget is None:
+        return None
+    used = current_rss()
+    if used is None:
+        used = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+    return budget - used
+
+
+def _format_bytes(nbytes):
+    if nbytes is None:
+        return "-"
+    return f"{nbytes / 2**20:,.1f} MB"
+
+
+def report_text():
+    """
+    Builds the per-stage memory report.
+
+    Returns:
+        str: One line per recorded stage.
+    """
+    lines = [f"{'Stage':<28}{'RSS before':>14}{'RSS after':>14}{'Peak RSS':>14}{'Traced peak':>14}"]
+    for name, stage_info in _stages.items():
+        traced = stage_info.get('traced_peak')
+        lines.append(f"{name:<28}{_format_bytes(stage_info['rss_before']):>14}"
+                     f"{_format_bytes(stage_info['rss_after']):>14}{_format_bytes(stage_info['peak_rss']):>14}"
+                     f"{_format_bytes(traced) if traced is not None else '-':>14}")
+        for line in stage_info.get('top_allocations', []):
+            lines.append(f"    {line}")
+    return "\n".join(lines)
+
+
+def report():
+    """Prints the per-stage memory report."""
+    print(report_text())
+
+
+def stages():
+    """Recorded measures of every stage."""
+    return {name: dict(stage_info) for name, stage_info in _stages.items()}
+
+
+@contextmanager
+def stage(name, snapshot=False):
+    """
+    Records the memory used by a pipeline stage.
+
+    Resident memory is always recorded. With tracking enabled the tracemalloc peak of the
+    stage is recorded too, and optionally its ten largest allocation sites.
+
+    Args:
+        name (str): Name of the stage.
+        snapshot (bool): Keep the largest allocation sites of the stage.
+    """
+    stage_info = {'rss_before': current_rss()}
+    started_tracing = False
+    if tracking:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        if tracking:
+            stage_info['traced_peak'] = tracemalloc.get_traced_memory()[1]
+            if snapshot:
+                statistics = tracemalloc.take_snapshot().statistics('lineno')[:10]
+                stage_info['top_allocations'] = [str(statistic) for statistic in statistics]
+            if started_tracing:
+                tracemalloc.stop()
+        stage_info['rss_after'] = current_rss()
+        stage_info['peak_rss'] = peak_rss()
+        _stages[name] = stage_info
+
+
+def require(name, nbytes):
+    """
+    Fails early when an allocation cannot fit in the remaining budget.
+
+    Args:
+        name (str): Stage doing the allocation, used in the report.
+        nbytes (int): Size of the planned allocation in bytes.
+
+    Raises:
+        MemoryBudgetExceeded: If the allocation would exceed the budget.
+    """
+    left = available()
+    if left is not None and nbytes > left:
+        raise MemoryBudgetExceeded(
+            f"{name} needs {_format_bytes(nbytes)} but only {_format_bytes(max(left, 0))} of the "
+            f"{_format_bytes(budget)} budget are left (resident: {_format_bytes(current_rss())}).\n"
+            + report_text())
+
+
+def chunk_rows(name, bytes_per_row, n_rows):
+    """
+    Number of rows a chunked computation may process at once within the budget.
+
+    Args:
+        name (str): Stage doing the allocation, used in the report.
+        bytes_per_row (int): Temporary memory needed per row.
+        n_rows (int): Total number of rows.
+
+    Returns:
+        int: Rows per chunk, n_rows without a budget.
+
+    Raises:
+        MemoryBudgetExceeded: If not even a single row fits.
+    """
+    left = available()
+    if left is None:
+        return n_rows
+    require(name, bytes_per_row)
+    return max(1, min(n_rows, left // bytes_per_row))
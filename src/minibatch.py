@@ -0,0 +1,150 @@
+# minibatch.py
+# Mini-batch variant of the topological k-centroids clustering for large cohorts
+# Every iteration reads a random batch of subjects from a memory-mapped FeatureStore,
+# so the cost of an iteration does not grow with the cohort
+# Author: Boqian Shi
+
+import random
+import numpy as np
+import config
+import src.barcode
+import src.instrument as instrument
+import src.memory as memory
+from src.clustering import k_centroids_clustering, topological_weight_array
+
+
+class minibatch_k_centroids_clustering(k_centroids_clustering):
+    """
+    Mini-batch topological k-centroids clustering.
+
+    Every iteration assigns a random batch of subjects to their nearest centroid and
+    folds the batch means into per-cluster running means with the decaying step size
+    batch count / total count of the cluster (mini-batch k-means). The centroids of the
+    clusters present in the batch are then moved towards their running means by the
+    topological interpolation, warm-started from the current centroid. The final labels
+    come from one chunked pass over the store.
+
+    Args:
+        feature_store (FeatureStore): Barcodes of the cohort.
+        n_clusters (int): Number of clusters.
+        top_relative_weight (float): Weight of the topological term, between 0 and 1.
+        max_iter (int): Maximum number of mini-batch iterations.
+        max_iter_interp (int): Maximum number of gradient steps per centroid update.
+        learning_rate (float): Step size of the topological interpolation.
+        batch_size (int): Number of subjects per batch.
+        max_no_improvement (int): Stop after this many iterations without improvement of
+            the smoothed batch loss, None to always run max_iter iterations.
+        **kwargs: Other options of k_centroids_clustering (optimizer, interp_tol, init...).
+            sample_weight, centroid_cache, sketch_components and an unchanged_policy other
+            than "recompute" rely on full passes over the cohort and are rejected.
+    """
+
+    def __init__(self, feature_store, n_clusters, top_relative_weight, max_iter, max_iter_interp,
+                 learning_rate, batch_size=32, max_no_improvement=10, **kwargs):
+        super().__init__(None, n_clusters, top_relative_weight, max_iter, max_iter_interp,
+                         learning_rate, **kwargs)
+        if (self.sample_weight is not None or self.centroid_cache is not None
+                or self.sketch_components is not None or self.unchanged_policy != "recompute"):
+            raise ValueError("sample_weight, centroid_cache, sketch_components and unchanged_policy "
+                             "not supported in minibatch_k_centroids_clustering")
+        self.feature_store = feature_store
+        self.batch_size = batch_size
+        self.max_no_improvement = max_no_improvement
+
+    def _fit_predict(self):
+        random.seed(config.random_seed)
+        store = self.feature_store
+        n_rows = len(store)
+        batch_size = min(self.batch_size, n_rows)
+
+        topo_only = config.geo_mode == "topo"
+        if config.geo_mode not in ("geo_included", "topo"):
+            raise ValueError(f"Geo Mode {config.geo_mode} not supported in minibatch_k_centroids_clustering")
+        n_edges = store.n_features // 2
+        n_births = src.barcode.n_node_from_edges(n_edges) - 1
+        self.weight_array = topological_weight_array(self.top_relative_weight, store.n_features)
+
+        # Initial centroids among the subjects of a first batch
+        init_rows = store.rows(random.sample(range(n_rows), batch_size))
+        if self.init == "random":
+            self.centroids = init_rows[random.sample(range(batch_size), self.n_clusters)]
+        else:
+            self.centroids = init_rows[self._kmeans_plus_plus(init_rows, greedy=self.init == "greedy_kmeans++")]
+
+        running_means = self.centroids.copy()
+        counts = np.zeros(self.n_clusters, dtype=np.int64)
+        self.loss_history = []
+        self.interp_steps = []
+        self.interp_seconds = []
+        self.interp_evaluations = []
+        self.n_iter = 0
+        smoothed_loss = None
+        best_loss = None
+        no_improvement = 0
+
+        for it in range(self.max_iter_alt):
+            instrument.count("minibatch_iterations")
+            self.n_iter += 1
+            batch = store.rows(random.sample(range(n_rows), batch_size))
+            assigned = self._get_nearest_centroid(batch[:, None, :], self.centroids[None, :, :])
+
+            loss = self._compute_top_dist(batch, self.centroids[assigned]).mean()
+            self.loss_history.append(loss)
+            instrument.trace("batch_loss", loss)
+
+            for cluster in np.unique(assigned):
+                members = batch[assigned == cluster]
+                counts[cluster] += len(members)
+                step = len(members) / counts[cluster]
+                running_means[cluster] += step * (members.mean(axis=0) - running_means[cluster])
+
+                if topo_only:
+                    # Barycenter of the sorted sets, see k_centroids_clustering.fit_predict
+                    self.centroids[cluster] = running_means[cluster]
+                    continue
+
+                prev_centroid = self.centroids[cluster][:n_edges].copy()
+                cluster_centroid, matching = self._top_interpolation(
+                    prev_centroid, running_means[cluster][:n_edges],
+                    running_means[cluster][n_edges:n_edges + n_births],
+                    running_means[cluster][n_edges + n_births:])
+                self.centroids[cluster] = self._centroid_barcode(cluster_centroid, matching)
+
+            # Early stopping on the exponentially smoothed batch loss, as in mini-batch k-means
+            if self.max_no_improvement is not None:
+                alpha = min(1.0, 2 * batch_size / (n_rows + 1))
+                smoothed_loss = loss if smoothed_loss is None else (1 - alpha) * smoothed_loss + alpha * loss
+                if best_loss is None or smoothed_loss < best_loss:
+                    best_loss = smoothed_loss
+                    no_improvement = 0
+                else:
+                    no_improvement += 1
+                    if no_improvement >= self.max_no_improvement:
+                        break
+
+        return self.predict()
+
+    def predict(self, X=None):
+        """
+        Assigns every subject of the store, or the rows of X, to its nearest centroid.
+
+        Args:
+            X (numpy.ndarray, optional): Barcodes (n_samples, n_features).
+
+        Returns:
+            numpy.ndarray: Cluster index of every subject.
+        """
+        if X is not None:
+            return super().predict(X)
+        store = self.feature_store
+        # Each chunk row is broadcast against every centroid by _get_nearest_centroid
+        bytes_per_row = (2 * self.n_clusters + 1) * store.n_features * store.features.itemsize
+        rows = memory.chunk_rows("minibatch_predict", bytes_per_row, len(store))
+        if memory.budget is None:
+            # Without a budget, stay lazy: read the store a batch at a time
+            rows = min(rows, self.batch_size)
+        labels = np.empty(len(store), dtype=np.intp)
+        for start, chunk in store.iter_chunks(rows):
+            labels[start:start + len(chunk)] = self._get_nearest_centroid(
+                chunk[:, None, :], self.centroids[None, :, :])
+        return labels
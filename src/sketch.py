@@ -0,0 +1,113 @@
+# sketch.py
+# Random-projection sketches for approximate nearest-centroid assignment
+# The weighted barcodes are projected once to a few thousand dimensions with a sparse
+# Johnson-Lindenstrauss projection; assignments come from the sketches and only the
+# subjects close to a cluster boundary are re-checked on the full barcodes
+# Author: Boqian Shi
+
+import numpy as np
+import src.instrument as instrument
+from sklearn.random_projection import SparseRandomProjection
+
+
+class DistanceSketch:
+    """
+    Sketch of a set of rows under the weighted squared distance
+        d(x, c) = sum(weight_array * (x - c)**2)
+    which equals the squared Euclidean distance between sqrt(weight_array) * x and
+    sqrt(weight_array) * c, so a JL projection of the scaled rows preserves it up to a
+    relative error of about sqrt(2 / n_components).
+
+    Args:
+        n_components (int): Dimension of the sketches.
+        margin (float, optional): A row is re-checked exactly when its two closest
+            centroids are within this relative gap in the sketch, i.e. d2 - d1 <= margin * d1.
+            Defaults to four times the typical relative error, 4 * sqrt(2 / n_components).
+        random_state (int): Seed of the projection.
+    """
+
+    def __init__(self, n_components=2048, margin=None, random_state=0):
+        self.n_components = n_components
+        self.margin = margin if margin is not None else 4 * np.sqrt(2 / n_components)
+        self.random_state = random_state
+        self.n_rechecked = 0
+
+    def fit(self, X, weight_array):
+        """
+        Projects the rows once.
+
+        Args:
+            X (numpy.ndarray): Rows (n_samples, n_features).
+            weight_array (numpy.ndarray): Feature weights of the distance.
+
+        Returns:
+            DistanceSketch: self.
+        """
+        self.X = X
+        self.weight_array = weight_array
+        self.scale = np.sqrt(weight_array)
+        self.projection = SparseRandomProjection(n_components=min(self.n_components, X.shape[1]),
+                                                 dense_output=True, random_state=self.random_state)
+        self.sketches = self.projection.fit_transform(X * self.scale)
+        return self
+
+    def transform(self, rows):
+        """Sketches of other rows, e.g. centroids."""
+        return self.projection.transform(np.atleast_2d(rows) * self.scale)
+
+    def approximate_distances(self, centroids):
+        """
+        Sketched weighted squared distances from every row to every centroid.
+
+        Args:
+            centroids (numpy.ndarray): Centroids (n_clusters, n_features).
+
+        Returns:
+            numpy.ndarray: Distances (n_samples, n_clusters).
+        """
+        centroid_sketches = self.transform(centroids)
+        return ((self.sketches[:, None, :] - centroid_sketches[None, :, :])**2).sum(axis=2)
+
+    def assign(self, centroids):
+        """
+        Nearest centroid of every row, exact for the rows near a boundary.
+
+        Args:
+            centroids (numpy.ndarray): Centroids (n_clusters, n_features).
+
+        Returns:
+            tuple: Cluster index of every row and the distance of every row to it (exact
+                for the re-checked rows, sketched for the others).
+        """
+        distances = self.approximate_distances(centroids)
+        labels = np.argmin(distances, axis=1)
+        if distances.shape[1] > 1:
+            closest_two = np.partition(distances, 1, axis=1)[:, :2]
+            ambiguous = np.flatnonzero(closest_two[:, 1] - closest_two[:, 0] <= self.margin * closest_two[:, 0])
+        else:
+            ambiguous = np.arange(0)
+        if len(ambiguous):
+            exact = np.dot((self.X[ambiguous, None, :] - centroids[None, :, :])**2, self.weight_array)
+            labels[ambiguous] = np.argmin(exact, axis=1)
+            distances[ambiguous] = exact
+        self.n_rechecked += len(ambiguous)
+        instrument.count("sketch_rechecks", len(ambiguous))
+        return labels, distances[np.arange(len(labels)), labels]
+
+    def error(self, centroids):
+        """
+        Measures the sketch error against the exact distances.
+
+        Args:
+            centroids (numpy.ndarray): Centroids (n_clusters, n_features).
+
+        Returns:
+            dict: Mean and maximum relative error of the sketched distances, and the
+                fraction of rows whose sketched nearest centroid is wrong.
+        """
+        approximate = self.approximate_distances(centroids)
+        exact = np.dot((self.X[:, None, :] - centroids[None, :, :])**2, self.weight_array)
+        relative = np.abs(approximate - exact) / np.maximum(exact, np.finfo(exact.dtype).tiny)
+        return {'mean_relative_error': float(relative.mean()),
+                'max_relative_error': float(relative.max()),
+                'mislabeled_fraction': float(np.mean(approximate.argmin(axis=1) != exact.argmin(axis=1)))}
@@ -7,6 +7,8 @@ import config
 import os
 import csv
 import numpy as np
+import src.instrument as instrument
+import src.memory as memory
 
 class Subject:
     def __init__(self, subject_id, group=None):
@@ -35,6 +37,7 @@ class Subject:
         file_path = os.path.join(data_dir, file_name)
         if os.path.exists(file_path):
             self.data = np.load(file_path)
+            instrument.count("bytes_loaded", self.data.nbytes)
 
     def set_barcode(self, barcode):
         """
@@ -57,8 +60,10 @@ class SubjectLoader:
     def load_subjects_from_data_dir(self):
         """
         Loads subjects from the data directory.
+        Files are sorted so the subject order, and with it every seeded result,
+        does not depend on the file system.
         """
-        for file_name in os.listdir(config.data_dir):
+        for file_name in sorted(os.listdir(config.data_dir)):
             if file_name.endswith('.npy'):
                 subject_id = file_name[4:12]  # Extract the subject ID from the file name
                 subject = Subject(subject_id)
@@ -119,8 +124,9 @@ class SubjectLoader:
         """
         Loads data for all subjects from the data directory.
         """
-        for subject in self.subjects:
-            subject.load_data(config.data_dir)
+        with instrument.timer("load_subject_data"), memory.stage("load_subject_data"):
+            for subject in self.subjects:
+                subject.load_data(config.data_dir)
 
     def strict_binary_label(self):
         """
@@ -1,10 +1,13 @@
 # src/svm.py
+import os
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.model_selection import KFold
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC
 from sklearn.metrics import confusion_matrix
 import config
+import src.memory as memory
 import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA
 from sklearn.svm import SVC
@@ -12,6 +15,8 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import adjusted_rand_score
+from sklearn.metrics.pairwise import rbf_kernel
+from scipy.ndimage import binary_dilation
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -28,6 +33,9 @@ def run_svm_classification(subjects, l1 = 1, l2 = 1, c_value = 1, cv_folds=5, ra
     Returns:
     - A dictionary containing the accuracy score, confusion matrix, and CV scores for each fold.
     """
+    # The stacked barcodes, the fold copies and their standardized versions are about
+    # three times the size of the stacked matrix
+    memory.require("run_svm_classification", 3 * len(subjects) * subjects[0].barcode.nbytes)
     # Extract barcode vector data and their corresponding labels
     X = np.array([subject.barcode for subject in subjects])
     y = np.array([subject.group for subject in subjects])
@@ -76,6 +84,123 @@ def run_svm_classification(subjects, l1 = 1, l2 = 1, c_value = 1, cv_folds=5, ra
         'cv_scores': cv_scores
     }
 
+def precompute_fold_kernels(X, cv_folds=5, random_state=0):
+    """
+    Precomputes the standardized RBF kernels used by run_svm_classification for every fold.
+
+    The scaler and the kernel only depend on the features, so they can be shared by any
+    number of label vectors evaluated on the same folds.
+
+    Parameters:
+    - X: Barcode matrix of shape (n_subjects, n_features).
+    - cv_folds: Number of folds for cross-validation.
+    - random_state: Seed of the KFold shuffling, same meaning as in run_svm_classification.
+
+    Returns:
+    - A list of (train_index, test_index, K_train, K_test) tuples, one per fold.
+    """
+    kf = KFold(n_splits=cv_folds, shuffle=True, random_state=random_state)
+    folds = []
+    for train_index, test_index in kf.split(X):
+        scaler = StandardScaler().fit(X[train_index])
+        X_train_transformed = scaler.transform(X[train_index])
+        X_test_transformed = scaler.transform(X[test_index])
+
+        # Same gamma as SVC(gamma='scale') would pick on the transformed training data
+        X_var = X_train_transformed.var()
+        gamma = 1.0 / (X_train_transformed.shape[1] * X_var) if X_var != 0 else 1.0
+        K_train = rbf_kernel(X_train_transformed, X_train_transformed, gamma=gamma)
+        K_test = rbf_kernel(X_test_transformed, X_train_transformed, gamma=gamma)
+        folds.append((train_index, test_index, K_train, K_test))
+    return folds
+
+def kernel_cv_score(folds, y, c_value=1):
+    """
+    Average cross-validation accuracy of an SVM trained on precomputed fold kernels.
+
+    Parameters:
+    - folds: Output of precompute_fold_kernels.
+    - y: Labels of all subjects.
+    - c_value: Regularization parameter of the SVM.
+
+    Returns:
+    - The mean accuracy over the folds.
+    """
+    scores = []
+    for train_index, test_index, K_train, K_test in folds:
+        y_train, y_test = y[train_index], y[test_index]
+        if len(np.unique(y_train)) < 2:
+            # A shuffle can leave a single class in the training fold, SVC cannot fit that
+            scores.append(np.mean(y_test == y_train[0]))
+            continue
+        clf = SVC(C=c_value, kernel='precomputed').fit(K_train, y_train)
+        scores.append(clf.score(K_test, y_test))
+    return np.mean(scores)
+
+# State shared with the permutation workers, set once per process by the pool initializer
+_permutation_state = None
+
+def _init_permutation_worker(folds, y, c_value):
+    global _permutation_state
+    _permutation_state = (folds, y, c_value)
+
+def _permutation_batch(seed, n_permutations):
+    folds, y, c_value = _permutation_state
+    rng = np.random.default_rng(seed)
+    return np.array([kernel_cv_score(folds, rng.permutation(y), c_value) for _ in range(n_permutations)])
+
+def permutation_test(subjects, n_permutations=1000, c_value=1, cv_folds=5, random_state=0,
+                     batch_size=100, n_jobs=None):
+    """
+    Label permutation test for the accuracy reported by run_svm_classification.
+
+    The fold splits, scalers and kernels are computed once, since shuffling labels never
+    changes the features; every permutation only refits the SVM on the cached kernels.
+    Permutations are split in batches that run on a process pool. The lambda label scaling
+    of run_svm_classification (l1, l2) depends on the labels and is not supported here.
+
+    Parameters:
+    - subjects: List of Subject objects with barcode data and labels.
+    - n_permutations: Number of shuffled label vectors in the null distribution.
+    - c_value: Regularization parameter of the SVM.
+    - cv_folds: Number of folds for cross-validation.
+    - random_state: Seed for the fold splits and for the permutations.
+    - batch_size: Number of permutations evaluated per task.
+    - n_jobs: Number of worker processes, defaults to the number of CPUs. 1 runs in-process.
+
+    Returns:
+    - A dictionary containing the observed average score, the null distribution and the p-value.
+    """
+    memory.require("permutation_test", 3 * len(subjects) * subjects[0].barcode.nbytes)
+    X = np.array([subject.barcode for subject in subjects])
+    y = np.array([subject.group for subject in subjects])
+
+    folds = precompute_fold_kernels(X, cv_folds, random_state)
+    average_score = kernel_cv_score(folds, y, c_value)
+
+    # One independent stream per batch, so the result does not depend on n_jobs
+    batch_sizes = [min(batch_size, n_permutations - start) for start in range(0, n_permutations, batch_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(batch_sizes))
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1:
+        _init_permutation_worker(folds, y, c_value)
+        batches = [_permutation_batch(seed, size) for seed, size in zip(seeds, batch_sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_permutation_worker,
+                                 initargs=(folds, y, c_value)) as executor:
+            batches = list(executor.map(_permutation_batch, seeds, batch_sizes))
+
+    null_distribution = np.concatenate(batches) if batches else np.empty(0)
+    p_value = (np.sum(null_distribution >= average_score) + 1) / (len(null_distribution) + 1)
+
+    return {
+        'average_score': average_score,
+        'null_distribution': null_distribution,
+        'p_value': p_value
+    }
+
 def lambda_adjustment(x_t, y_t, l1, l2):
 
     if y_t == 1:
@@ -88,6 +213,20 @@ def lambda_adjustment(x_t, y_t, l1, l2):
 
 
 def tsne_svm(data, labels, l):
+    """
+    Fits the SVM of a 2D embedding and scores its predictions with the Adjusted Rand Index.
+
+    The decision boundary is not rendered here, a sweep only pays for the grid of the
+    result it plots (see decision_boundary).
+
+    Parameters:
+    - data: Embedding of the subjects (n_samples, 2).
+    - labels: Binary label of every subject.
+    - l: Lambda of the barcodes, for the log line.
+
+    Returns:
+    - The ARI score, the fitted SVC, the standardized embedding and the labels.
+    """
     scaler = StandardScaler()
     data_scaled = scaler.fit_transform(data)
     if config.separation_mode == "strict_binary":
@@ -100,19 +239,74 @@ def tsne_svm(data, labels, l):
     svc = SVC(kernel=kernel, C=1, gamma='auto')
     svc.fit(data_scaled, labels)
 
-    # Create a mesh to plot the decision boundary
-    x_min, x_max = data_scaled[:, 0].min() - 1, data_scaled[:, 0].max() + 1
-    y_min, y_max = data_scaled[:, 1].min() - 1, data_scaled[:, 1].max() + 1
-    xx, yy = np.meshgrid(np.arange(x_min, x_max, 0.02),
-                        np.arange(y_min, y_max, 0.02))
-
-    # Predict on the mesh and reshape for plotting
-    Z = svc.predict(np.c_[xx.ravel(), yy.ravel()])
-    Z = Z.reshape(xx.shape)
-    
     # Predict the labels using the trained model
     predicted_labels = svc.predict(data_scaled)
     # Calculate and print the ARI score
     ari_score = adjusted_rand_score(labels, predicted_labels)
     print(f"Adjusted Rand Index score: {ari_score:.4f} with lambda = {l:.4f}")
-    return ari_score, xx, yy, Z, data_scaled, labels
\ No newline at end of file
+    return ari_score, svc, data_scaled, labels
+
+def _grid_nodes(n, factor):
+    # Every factor-th node of an axis of n nodes, always including the last one
+    nodes = np.arange(0, n, factor)
+    return nodes if nodes[-1] == n - 1 else np.append(nodes, n - 1)
+
+def decision_boundary(svc, data_scaled, step=0.02, coarse_factor=16):
+    """
+    Predicted class of the SVM on a mesh around the embedding, for contour plots.
+
+    The mesh is the one of a plain np.meshgrid with the given step, but it is evaluated
+    coarse to fine: the classes are predicted every coarse_factor nodes, then the
+    resolution is doubled until it reaches step, predicting only the nodes next to a
+    coarse cell whose corners disagree and filling the others from the corners. The
+    result matches the full grid except for class islands smaller than a coarse cell.
+
+    Parameters:
+    - svc: Fitted classifier, as returned by tsne_svm.
+    - data_scaled: Standardized embedding the classifier was fitted on.
+    - step: Resolution of the mesh.
+    - coarse_factor: Spacing of the first pass in nodes, a power of two. 1 predicts every node.
+
+    Returns:
+    - The mesh coordinates xx, yy and the predicted class Z of every node.
+    """
+    x_min, x_max = data_scaled[:, 0].min() - 1, data_scaled[:, 0].max() + 1
+    y_min, y_max = data_scaled[:, 1].min() - 1, data_scaled[:, 1].max() + 1
+    xx, yy = np.meshgrid(np.arange(x_min, x_max, step),
+                        np.arange(y_min, y_max, step))
+    n_rows, n_cols = xx.shape
+    Z = np.empty(xx.shape, dtype=svc.classes_.dtype)
+
+    def predict(rows, cols):
+        Z[rows, cols] = svc.predict(np.c_[xx[rows, cols], yy[rows, cols]])
+
+    factor = coarse_factor
+    rows, cols = _grid_nodes(n_rows, factor), _grid_nodes(n_cols, factor)
+    mesh_rows, mesh_cols = np.meshgrid(rows, cols, indexing='ij')
+    predict(mesh_rows.ravel(), mesh_cols.ravel())
+
+    while factor > 1:
+        corners = Z[np.ix_(rows, cols)]
+        if len(rows) > 1 and len(cols) > 1:
+            mixed = ((corners[:-1, :-1] != corners[1:, :-1]) | (corners[:-1, :-1] != corners[:-1, 1:])
+                     | (corners[:-1, :-1] != corners[1:, 1:]))
+            # The boundary can leave a cell through its edges, refine the neighbours too
+            mixed = binary_dilation(mixed, structure=np.ones((3, 3), dtype=bool))
+        else:
+            mixed = np.ones((max(len(rows) - 1, 1), max(len(cols) - 1, 1)), dtype=bool)
+
+        factor //= 2
+        new_rows, new_cols = _grid_nodes(n_rows, factor), _grid_nodes(n_cols, factor)
+        mesh_rows, mesh_cols = np.meshgrid(new_rows, new_cols, indexing='ij')
+        known = np.isin(mesh_rows, rows) & np.isin(mesh_cols, cols)
+        # Coarse cell of every new node
+        cell_rows = np.clip(np.searchsorted(rows, mesh_rows, side='right') - 1, 0, mixed.shape[0] - 1)
+        cell_cols = np.clip(np.searchsorted(cols, mesh_cols, side='right') - 1, 0, mixed.shape[1] - 1)
+        refine = ~known & mixed[cell_rows, cell_cols]
+        fill = ~known & ~refine
+        if refine.any():
+            predict(mesh_rows[refine], mesh_cols[refine])
+        Z[mesh_rows[fill], mesh_cols[fill]] = corners[cell_rows[fill], cell_cols[fill]]
+        rows, cols = new_rows, new_cols
+
+    return xx, yy, Z
@@ -0,0 +1,174 @@
+# synthetic.py
+# Generator of synthetic connectome cohorts for scale testing
+# Writes the same sub-XXXXXXXX.npy + matrix_subjects.csv layout that SubjectLoader reads
+# Author: Boqian Shi
+#
+# Usage (from the repository root):
+#     python -m src.synthetic --out ./synthetic --subjects 1000 --nodes 360
+
+import argparse
+import csv
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_GROUPS = ('AD', 'CN', 'LMCI', 'EMCI')
+
+
+def synthetic_subject_id(index):
+    """
+    Builds an 8 character ADNI-like subject ID, e.g. 900S0042.
+
+    Sites start at 900 so synthetic IDs never collide with the real ones.
+
+    Args:
+        index (int): Index of the subject in the cohort.
+
+    Returns:
+        str: Subject ID.
+    """
+    return f"{900 + index // 10000:03d}S{index % 10000:04d}"
+
+
+def planted_templates(n_nodes, n_groups, n_modules=7, group_effect=0.5, seed=0):
+    """
+    Draws the module layout shared by all subjects and the per-group module strengths.
+
+    Nodes are split into contiguous modules (the 7 default mimic the Yeo networks). Every
+    group gets its own coupling strength per module, so the groups differ in the strength
+    of their within-module correlations.
+
+    Args:
+        n_nodes (int): Number of nodes of each network.
+        n_groups (int): Number of groups.
+        n_modules (int): Number of modules.
+        group_effect (float): Spread of the module strengths between groups.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        tuple: Module index of every node (n_nodes,) and strengths (n_groups, n_modules).
+    """
+    rng = np.random.default_rng(seed)
+    modules = np.sort(rng.integers(0, n_modules, size=n_nodes))
+    base = rng.uniform(0.6, 1.2, size=n_modules)
+    strengths = base * (1 + group_effect * rng.uniform(-1, 1, size=(n_groups, n_modules)))
+    return modules, strengths
+
+
+def synthetic_connectome(modules, strengths, rng, n_timepoints=200, subject_noise=0.1, global_signal=0.3):
+    """
+    Pearson correlation matrix of simulated BOLD signals with planted modules.
+
+    Each node follows its module factor scaled by the module strength, a global signal and
+    independent noise. Subject variability comes from jittering the strengths.
+
+    Args:
+        modules (numpy.ndarray): Module index of every node.
+        strengths (numpy.ndarray): Module strengths of the subject's group.
+        rng (numpy.random.Generator): Random generator of the subject.
+        n_timepoints (int): Length of the simulated time series.
+        subject_noise (float): Relative jitter of the module strengths per subject.
+        global_signal (float): Weight of the signal shared by all nodes.
+
+    Returns:
+        numpy.ndarray: Symmetric correlation matrix with a unit diagonal.
+    """
+    n_modules = len(strengths)
+    subject_strengths = strengths * (1 + subject_noise * rng.normal(size=n_modules))
+    factors = rng.normal(size=(n_modules, n_timepoints))
+    series = subject_strengths[modules, None] * factors[modules]
+    series += global_signal * rng.normal(size=n_timepoints)
+    series += rng.normal(size=(len(modules), n_timepoints))
+    return np.corrcoef(series)
+
+
+def _generate_chunk(args):
+    """Worker: generates, writes and forgets a chunk of subjects, returns their CSV rows."""
+    (indices, group_indices, groups, modules, strengths, data_dir, seed,
+     n_timepoints, subject_noise, dtype) = args
+    rows = []
+    for index, group_index in zip(indices, group_indices):
+        # One stream per subject, so the cohort does not depend on chunking or n_jobs
+        rng = np.random.default_rng([seed, index])
+        adj = synthetic_connectome(modules, strengths[group_index], rng, n_timepoints, subject_noise)
+        subject_id = synthetic_subject_id(index)
+        data_file = os.path.join(data_dir, f"sub-{subject_id}.npy")
+        np.save(data_file, adj.astype(dtype, copy=False))
+        rows.append({'participant_id': subject_id, 'group': groups[group_index], 'data_file': data_file})
+    return rows
+
+
+def generate_cohort(data_dir, csv_file, n_subjects, n_nodes=360, groups=DEFAULT_GROUPS, n_modules=7,
+                    group_effect=0.5, n_timepoints=200, subject_noise=0.1, seed=0, dtype=np.float64,
+                    chunk_size=64, n_jobs=None):
+    """
+    Writes a synthetic cohort of connectomes with planted group structure.
+
+    Subjects are generated in chunks on a process pool. Every worker writes its matrices
+    straight to disk and only returns the CSV rows, which are streamed to the CSV file in
+    order, so memory stays bounded by one chunk whatever the cohort size.
+
+    Args:
+        data_dir (str): Directory receiving the sub-XXXXXXXX.npy files.
+        csv_file (str): Path of the subject CSV (participant_id, group, data_file).
+        n_subjects (int): Number of subjects.
+        n_nodes (int): Number of nodes of each network.
+        groups (sequence): Group names, subjects are spread evenly over them.
+        n_modules (int): Number of planted modules.
+        group_effect (float): Spread of the module strengths between groups.
+        n_timepoints (int): Length of the simulated time series.
+        subject_noise (float): Relative jitter of the module strengths per subject.
+        seed (int): Seed of the cohort.
+        dtype (numpy.dtype): Data type of the saved matrices.
+        chunk_size (int): Number of subjects per task.
+        n_jobs (int): Number of worker processes, defaults to the number of CPUs. 1 runs in-process.
+
+    Returns:
+        dict: Number of subjects written per group.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    groups = list(groups)
+    modules, strengths = planted_templates(n_nodes, len(groups), n_modules, group_effect, seed)
+    group_indices = np.random.default_rng(seed).permutation(np.arange(n_subjects) % len(groups))
+
+    tasks = ((range(start, min(start + chunk_size, n_subjects)),
+              group_indices[start:start + chunk_size], groups, modules, strengths, data_dir, seed,
+              n_timepoints, subject_noise, dtype)
+             for start in range(0, n_subjects, chunk_size))
+
+    counts = {group: 0 for group in groups}
+    executor = None if n_jobs == 1 else ProcessPoolExecutor(max_workers=n_jobs)
+    chunks = map(_generate_chunk, tasks) if executor is None else executor.map(_generate_chunk, tasks)
+    try:
+        with open(csv_file, 'w', newline='') as file:
+            csv_writer = csv.DictWriter(file, fieldnames=['participant_id', 'group', 'data_file'])
+            csv_writer.writeheader()
+            for rows in chunks:
+                csv_writer.writerows(rows)
+                for row in rows:
+                    counts[row['group']] += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic connectome cohort.")
+    parser.add_argument('--out', default='./synthetic', help="output directory")
+    parser.add_argument('--subjects', type=int, default=1000, help="number of subjects")
+    parser.add_argument('--nodes', type=int, default=360, help="number of nodes per network")
+    parser.add_argument('--modules', type=int, default=7, help="number of planted modules")
+    parser.add_argument('--group-effect', type=float, default=0.5, help="spread of module strengths between groups")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the cohort")
+    parser.add_argument('--float32', action='store_true', help="save matrices as float32")
+    parser.add_argument('--jobs', type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    data_dir = os.path.join(args.out, 'data')
+    csv_file = os.path.join(args.out, 'matrix_subjects.csv')
+    counts = generate_cohort(data_dir, csv_file, args.subjects, args.nodes, n_modules=args.modules,
+                             group_effect=args.group_effect, seed=args.seed,
+                             dtype=np.float32 if args.float32 else np.float64, n_jobs=args.jobs)
+    print(f"Wrote {sum(counts.values())} subjects to {data_dir}: {counts}")
+    print(f"Point config.data_dir to '{data_dir}' and config.subject_csv_file to '{csv_file}' to use it.")